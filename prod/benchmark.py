@@ -0,0 +1,489 @@
+'''
+Throughput benchmark of indexer.py. It loads synthetic collections into
+mongomock (or a mongod), runs the real index_collection of every mode
+and engine against a local stand-in of elasticsearch that speaks
+_bulk, _mget, _search and _update, and prints docs/s and the CPU
+seconds of each stage. Results can be saved and compared with a
+previous run to catch regressions.
+
+    python benchmark.py --docs 100000 --shape asmsco --save before.json
+    python benchmark.py --docs 100000 --shape asmsco --baseline before.json
+'''
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+import optparse
+import resource
+import datetime
+import urllib2
+import random
+import socket
+import json
+import gzip
+import time
+import sys
+import StringIO
+
+import bson
+import bson.decimal128
+import pymongo
+
+import indexer
+
+BENCH_DB = 'benchmark'
+COMMON_TIMESTAMP = 'COMMON_TIMESTAMP'
+
+MODES = ('full', 'sync', 'update')
+ENGINES = ('sync', 'overlap', 'pipeline')
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# Synthetic documents, timestamps grow with i so sync has a watermark
+
+def asmsco_doc(i, ts, width):
+    # like ducksdev.asmsco, flattened by filters/asmsco.py
+    return {'timestamp': ts,
+            'data': [{'name': 'disk%d' %n,
+                      'free': random.randint(0, 1 << 30),
+                      'total': 1 << 30}
+                     for n in xrange(width)]}
+
+def wide_doc(i, ts, width):
+    doc = {'timestamp': ts}
+    for n in xrange(width):
+        doc['field%d' %n] = random.random() if n % 2 else 'value-%d' %(i + n)
+    return doc
+
+def mixed_doc(i, ts, width):
+    return {'timestamp': ts,
+            'count': i,
+            'ratio': random.random(),
+            'name': 'document %d' %i,
+            'enabled': i % 2 == 0,
+            'missing': None,
+            'day': ts.replace(hour=0, minute=0, second=0),
+            'price': bson.decimal128.Decimal128('%d.%02d' %(i, i % 100)),
+            'ref': bson.objectid.ObjectId(),
+            'tags': ['tag%d' %(n % 7) for n in xrange(width)],
+            'nested': {'level': i % 10,
+                       'path': '/data/%d' %(i % 1000),
+                       'sizes': [n * i for n in xrange(width)]}}
+
+SHAPES = {
+    'asmsco': (asmsco_doc, 'asmsco'),
+    'wide': (wide_doc, None),
+    'mixed': (mixed_doc, None)
+}
+
+def load(coll, shape, start, count, width, chunk=1000):
+    # Inserts count documents of shape after the first start ones
+    make_doc = SHAPES[shape][0]
+    base = datetime.datetime(2017, 1, 1)
+    batch = []
+    for i in xrange(start, start + count):
+        batch.append(make_doc(i, base + datetime.timedelta(seconds=i), width))
+        if len(batch) >= chunk:
+            coll.insert_many(batch)
+            batch = []
+
+    if len(batch) > 0:
+        coll.insert_many(batch)
+
+# elasticsearch stand-in
+
+class StubState(object):
+    '''
+    Documents by (index, type, id), kept as sources. Just enough of
+    the elasticsearch semantics for the indexer to run.
+    '''
+    def __init__(self):
+        self.docs = dict()
+        self.requests = 0
+
+    def bulk(self, body, default_index=None, default_type=None):
+        lines = body.splitlines()
+        items = []
+        errors = False
+
+        i = 0
+        while i < len(lines):
+            if lines[i].strip() == '':
+                i += 1
+                continue
+
+            action = json.loads(lines[i])
+            op_type, meta = action.items()[0]
+            key = (meta.get('_index', default_index),
+                   meta.get('_type', default_type),
+                   meta['_id'])
+
+            source = None
+            if op_type != 'delete':
+                source = json.loads(lines[i + 1])
+                i += 1
+            i += 1
+
+            status, result = self.apply(op_type, key, source)
+            item = {'_index': key[0],
+                    '_type': key[1],
+                    '_id': key[2],
+                    'status': status}
+            if result != None:
+                item['result'] = result
+            else:
+                errors = True
+                item['error'] = {'type': 'document_missing_exception',
+                                 'reason': 'document missing'}
+            items.append({op_type: item})
+
+        return {'took': 1, 'errors': errors, 'items': items}
+
+    def apply(self, op_type, key, source):
+        exists = self.docs.has_key(key)
+
+        if op_type in ('index', 'create'):
+            self.docs[key] = source
+            return (200, 'updated') if exists else (201, 'created')
+
+        if op_type == 'delete':
+            if not exists:
+                return 404, 'not_found'
+            del self.docs[key]
+            return 200, 'deleted'
+
+        # update
+        if not exists:
+            if not source.get('doc_as_upsert'):
+                return 404, None
+            self.docs[key] = dict(source['doc'])
+            return 201, 'created'
+
+        self.docs[key].update(source['doc'])
+        return 200, 'updated'
+
+    def search(self, index, doc_type, body):
+        hits = [(key, source) for key, source in self.docs.iteritems()
+                if key[0] == index and (doc_type == None or key[1] == doc_type)]
+
+        # only the first criterion matters to the indexer
+        sort = body.get('sort', [])
+        if len(sort) > 0:
+            field, order = sort[0].items()[0]
+            hits.sort(key=lambda hit: hit[1].get(field),
+                      reverse=order.get('order') == 'desc')
+
+        size = body.get('size', 10)
+        return {'took': 1,
+                'hits': {'total': len(hits),
+                         'hits': [{'_index': key[0],
+                                   '_type': key[1],
+                                   '_id': key[2],
+                                   '_source': source}
+                                  for key, source in hits[:size]]}}
+
+    def mget(self, body):
+        docs = []
+        for meta in body['docs']:
+            key = (meta['_index'], meta['_type'], meta['_id'])
+            found = dict(meta, found=self.docs.has_key(key))
+            fields = found.pop('_source', None)
+            if found['found']:
+                source = self.docs[key]
+                found['_source'] = dict((field, source[field])
+                                        for field in fields
+                                        if source.has_key(field))\
+                                   if isinstance(fields, list) else source
+            docs.append(found)
+        return {'docs': docs}
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body) if body != None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def body(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+        return data
+
+    def route(self):
+        state = self.server.state
+        state.requests += 1
+
+        path = self.path.split('?')[0]
+        parts = [part for part in path.split('/') if part != '']
+        data = self.body()
+
+        if len(parts) == 0:
+            return self.reply(200, {'version': {'number': '6.8.0'},
+                                    'tagline': 'You Know, for Search'})
+
+        if parts[0] == '_bench':
+            if self.command == 'DELETE':
+                state.docs.clear()
+            return self.reply(200, {'cpu': cpu_seconds(),
+                                    'docs': len(state.docs),
+                                    'requests': state.requests})
+
+        if parts[-1] == '_bulk':
+            return self.reply(200, state.bulk(data, *parts[:-1]))
+
+        if parts[-1] == '_mget':
+            return self.reply(200, state.mget(json.loads(data)))
+
+        if parts[-1] == '_search':
+            doc_type = parts[1] if len(parts) == 3 else None
+            return self.reply(200, state.search(parts[0],
+                                                doc_type,
+                                                json.loads(data or '{}')))
+
+        if parts[-1] == '_update' and len(parts) == 4:
+            response = state.bulk('\n'.join((json.dumps({'update': {'_id': parts[2]}}),
+                                             data)),
+                                  parts[0], parts[1])
+            item = response['items'][0]['update']
+            return self.reply(item['status'], item)
+
+        # index creation, templates, mappings...
+        return self.reply(200, {'acknowledged': True})
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = route
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve_stub(port, ready):
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    server.state = StubState()
+    ready.set()
+    server.serve_forever()
+
+def start_stub():
+    '''
+    Runs the stand-in in another process, so its CPU is measured apart
+    and does not compete for the GIL. Returns the process and port.
+    '''
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve_stub, args=(port, ready))
+    process.daemon = True
+    process.start()
+    ready.wait(10)
+    return process, port
+
+def stub_stats(port, reset=False):
+    request = urllib2.Request('http://127.0.0.1:%d/_bench' %port)
+    if reset:
+        request.get_method = lambda: 'DELETE'
+    return json.load(urllib2.urlopen(request))
+
+# Runs
+
+def run(mode, engine, index, filter_config, es_config, mongo_client, es, port,
+        profile=False):
+    # Returns the measures of one index_collection run
+    stub_before = stub_stats(port)
+    cpu_before = cpu_seconds()
+    start = time.time()
+
+    report = indexer.index_collection(
+        0, index, filter_config, es_config, mongo_client, es, mode, False,
+        verbose=False,
+        max_in_flight=es_config.max_in_flight if engine != 'sync' else 1,
+        pipeline=engine == 'pipeline',
+        profile=profile)
+
+    seconds = time.time() - start
+    stub_after = stub_stats(port)
+
+    return {'mode': mode,
+            'engine': engine,
+            'docs': report.done,
+            'failed': report.failed,
+            'seconds': seconds,
+            'docs_per_second': report.done / seconds if seconds > 0 else 0.0,
+            'cpu': {'indexer': cpu_seconds() - cpu_before,
+                    'elasticsearch': stub_after['cpu'] - stub_before['cpu']},
+            'requests': stub_after['requests'] - stub_before['requests'],
+            'stages': report.stages,
+            'profile': report.profile}
+
+def print_result(result):
+    stages = ''
+    if result['stages'] != None:
+        stages = indexer.format_stages(result['stages'])
+
+    print '%-7s %-9s %9d %8.2f %10.0f %8.2f %8.2f %6d  %s' %(
+        result['mode'],
+        result['engine'],
+        result['docs'],
+        result['seconds'],
+        result['docs_per_second'],
+        result['cpu']['indexer'],
+        result['cpu']['elasticsearch'],
+        result['failed'],
+        stages)
+
+    if result['profile'] != None:
+        print '%-17s %s' %('', indexer.format_profile(result['profile']))
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints the runs whose docs/s dropped more than tolerance (a
+    fraction) from baseline. Returns how many did.
+    '''
+    before = dict(((result['mode'], result['engine']), result)
+                  for result in baseline['results'])
+
+    regressions = 0
+    for result in results:
+        old = before.get((result['mode'], result['engine']))
+        if old == None or old['docs_per_second'] == 0:
+            continue
+
+        change = result['docs_per_second'] / old['docs_per_second'] - 1
+        if change < -tolerance:
+            regressions += 1
+            print '[ ! ] %s/%s: %.0f docs/s, was %.0f (%+.1f%%)' %(
+                result['mode'],
+                result['engine'],
+                result['docs_per_second'],
+                old['docs_per_second'],
+                change * 100)
+
+    return regressions
+
+def main():
+    optparser = optparse.OptionParser(usage='%prog [options]')
+    optparser.add_option('-n', '--docs', type='int', dest='docs',
+                         default=10000)
+    optparser.add_option('--sync-docs', type='int', dest='sync_docs',
+                         default=None,
+                         help='documents added before sync, default docs/10')
+    optparser.add_option('-s', '--shape', type='choice',
+                         choices=SHAPES.keys(), dest='shape',
+                         default='asmsco')
+    optparser.add_option('-w', '--width', type='int', dest='width',
+                         default=10,
+                         help='data entries, fields or list items per document')
+    optparser.add_option('--mongo', dest='mongo', default='mock',
+                         help='mongodb:// URI of a scratch mongod, or mock')
+    optparser.add_option('-e', '--engine', type='choice',
+                         choices=ENGINES, action='append', dest='engines')
+    optparser.add_option('-m', '--mode', type='choice',
+                         choices=MODES, action='append', dest='modes')
+    optparser.add_option('--field-format', dest='field_format',
+                         default='{coll}_{field}__{type}',
+                         help='common_field_format, empty to disable')
+    optparser.add_option('-b', '--bulk-size', dest='bulk_size', default='500')
+    optparser.add_option('--max-in-flight', dest='max_in_flight', default='4')
+    optparser.add_option('-p', '--profile', action='store_true',
+                         dest='profile', default=False,
+                         help='time every stage of the per-document loop')
+    optparser.add_option('--save', dest='save')
+    optparser.add_option('--baseline', dest='baseline')
+    optparser.add_option('--tolerance', type='float', dest='tolerance',
+                         default=0.1)
+    opts, args = optparser.parse_args()
+
+    if len(args) != 0:
+        optparser.error('no arguments expected')
+
+    engines = opts.engines or ENGINES
+    modes = opts.modes or MODES
+    sync_docs = opts.sync_docs if opts.sync_docs != None else opts.docs / 10
+
+    if opts.mongo == 'mock':
+        import mongomock
+        mongo_client = mongomock.MongoClient()
+    else:
+        mongo_client = pymongo.MongoClient(opts.mongo)
+
+    stub, port = start_stub()
+
+    es_config = indexer.ElasticsearchConfig(uri='127.0.0.1',
+                                            port=str(port),
+                                            bulk_size=opts.bulk_size,
+                                            max_in_flight=opts.max_in_flight)
+    es = es_config.client()
+
+    filter_config = indexer.FilterConfig(
+        common_timestamp=COMMON_TIMESTAMP,
+        common_field_format=opts.field_format or None)
+
+    index = indexer.IndexConfig(BENCH_DB, opts.shape,
+                                timestamp='timestamp',
+                                script=SHAPES[opts.shape][1])
+
+    print 'shape=%s width=%d docs=%d sync_docs=%d mongo=%s' %(
+        opts.shape, opts.width, opts.docs, sync_docs, opts.mongo)
+    print '%-7s %-9s %9s %8s %10s %8s %8s %6s  %s' %(
+        'MODE', 'ENGINE', 'DOCS', 'SECONDS', 'DOCS/S',
+        'CPU(IDX)', 'CPU(ES)', 'FAILED', 'STAGES')
+
+    results = []
+    for engine in engines:
+        coll = mongo_client[BENCH_DB][opts.shape]
+        coll.drop()
+        stub_stats(port, reset=True)
+
+        start = time.time()
+        cpu_before = cpu_seconds()
+        load(coll, opts.shape, 0, opts.docs, opts.width)
+        seconds = time.time() - start
+        print '%-7s %-9s %9d %8.2f %10.0f %8.2f' %(
+            'load', engine, opts.docs, seconds,
+            opts.docs / seconds if seconds > 0 else 0.0,
+            cpu_seconds() - cpu_before)
+
+        loaded = opts.docs
+        for mode in modes:
+            # sync needs something newer than what full indexed
+            if mode == 'sync':
+                load(coll, opts.shape, loaded, sync_docs, opts.width)
+                loaded += sync_docs
+
+            result = run(mode, engine, index, filter_config, es_config,
+                         mongo_client, es, port, opts.profile)
+            print_result(result)
+            results.append(result)
+
+    stub.terminate()
+
+    if opts.mongo == 'mock':
+        print '\nCPU(IDX) includes mongomock, use --mongo to leave it out.'
+
+    if opts.save != None:
+        with open(opts.save, 'w') as f:
+            json.dump({'options': vars(opts), 'results': results}, f,
+                      indent=2)
+
+    if opts.baseline != None:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, opts.tolerance) > 0:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,60 +1,364 @@
 import ConfigParser
 import sys
+import os
 import datetime
 import pymongo
+import pymongo.command_cursor
+import pymongo.errors
 import elasticsearch
+import elasticsearch.serializer
+import elasticsearch.connection_pool
 import bson
+import bson.son
 import dateutil.parser
+import bson.json_util
+import bson.decimal128
+import bson.int64
+import json
+import decimal
+import uuid
+import hashlib
+import struct
+import gzip
+import glob
 import optparse
+import sqlite3
+import time
+import multiprocessing
+import multiprocessing.pool
+import collections
+import threading
+import Queue
 
 def objectid_counter(objectid):
     # objectid: bson.objectid.ObjectId
     last3bytes = str(objectid)[-6:]
     return int('0x'+last3bytes, 16)
 
+def parse_bool(value):
+    return str(value).lower() in ('1', 'yes', 'true', 'on')
+
 class IndexConfig(object):
     def __init__(self, db_name, coll_name,
                  timestamp=None,
                  tsformat=None,
                  index=None,
                  type=None,
-                 script=None):
+                 script=None,
+                 partitions='1',
+                 query=None,
+                 projection=None,
+                 pipeline=None,
+                 batch_size='0',
+                 exhaust='false',
+                 reopen='false',
+                 read_ahead='1000',
+                 script_batch_size='1000',
+                 updated_field=None):
 
         self.db_name = db_name
         self.coll_name = coll_name
         self.timestamp = timestamp
         self.tsformat = tsformat
+        # modification time of the documents, update only reads what
+        # changed since its watermark (see update_cursor)
+        self.updated_field = updated_field
         self.index = db_name if index == None else index
         self.type = coll_name if type == None else type
+        # _id ranges scanned in parallel when running with --jobs
+        self.partitions = int(partitions)
+
+        # Extended JSON, run on the server (see find)
+        parse = lambda value: bson.json_util.loads(value) if value != None else None
+        self.query = parse(query)
+        self.projection = parse(projection)
+        self.pipeline = parse(pipeline)
+
+        # Cursor options, defaults come from the [mongo] section
+        self.batch_size = int(batch_size)
+        self.exhaust = parse_bool(exhaust)
+        # read in _id order, reopening after the last _id if the
+        # cursor is killed on the server
+        self.reopen = parse_bool(reopen)
+        # documents read in advance by --engine pipeline
+        self.read_ahead = int(read_ahead)
+
+        # documents per filter_batch() call of the script
+        self.script_batch_size = int(script_batch_size)
 
         if script == None:
             self.filter_fn = lambda doc: None
+            self.filter_batch_fn = None
         else:
             mod = __import__('filters.%s' %script)
             sub = getattr(mod, script)
-            self.filter_fn = sub.filter
+
+            # filter_batch(docs) is optional and preferred over
+            # filter(doc), scripts may define either one or both
+            self.filter_batch_fn = getattr(sub, 'filter_batch', None)
+            if hasattr(sub, 'filter'):
+                self.filter_fn = sub.filter
+            else:
+                self.filter_fn = lambda doc: self.filter_batch_fn([doc])
+
+            # Optional setup(config), once per collection
+            if hasattr(sub, 'setup'):
+                sub.setup(self)
 
 class ElasticsearchConfig(object):  
-    def __init__(self, user='', password='', uri='localhost', port='9200'):
+    def __init__(self, user='', password='', uri='localhost', port='9200',
+                 bulk_size='500',
+                 bulk_bytes='10485760',
+                 mget_size='500',
+                 max_in_flight='4',
+                 hosts=None,
+                 maxsize='10',
+                 http_compress='false',
+                 timeout='10',
+                 bulk_timeout='60',
+                 search_timeout='30',
+                 max_retries='5',
+                 retry_backoff='0.5',
+                 adaptive='false',
+                 target_latency='1.0',
+                 min_bulk_size='50',
+                 max_bulk_size='5000',
+                 dead_letter_dir=None):
         self.user = user
         self.password = password
         self.uri = uri
         self.port = port
-
-    def get_uri(self):
-        base = 'http://{0}'+self.uri+':'+self.port
+        # host:port list, requests are balanced round robin; uri and
+        # port are used if not set
+        self.hosts = [host.strip() for host in hosts.split(',')]\
+                     if hosts != None else [uri + ':' + port]
+        # keep-alive connections per host
+        self.maxsize = int(maxsize)
+        # gzip request bodies
+        self.http_compress = parse_bool(http_compress)
+        # seconds, default and per request class
+        self.timeout = float(timeout)
+        self.bulk_timeout = float(bulk_timeout)
+        self.search_timeout = float(search_timeout)
+        # retries of items rejected with 429, first wait in seconds
+        self.max_retries = int(max_retries)
+        self.retry_backoff = float(retry_backoff)
+        # tune bulk_size and requests in flight from latency
+        self.adaptive = parse_bool(adaptive)
+        self.target_latency = float(target_latency)
+        self.min_bulk_size = int(min_bulk_size)
+        self.max_bulk_size = int(max_bulk_size)
+        # rejected documents are spooled here for replay, if set
+        self.dead_letter_dir = dead_letter_dir
+        self.bulk_size = int(bulk_size)
+        self.bulk_bytes = int(bulk_bytes)
+        self.mget_size = int(mget_size)
+        # concurrent _bulk requests of the overlap engine
+        self.max_in_flight = int(max_in_flight)
+
+    def get_uri(self, host=None):
+        if host == None:
+            host = self.uri+':'+self.port
+        base = 'http://{0}'+host
         if self.user != '' and self.password != '':
             return base.format('{0}:{1}@'.format(self.user, self.password))
         else:
             return base.format('')
-        
+
+    def client(self):
+        return elasticsearch.Elasticsearch(
+            [self.get_uri(host) for host in self.hosts],
+            selector_class=elasticsearch.connection_pool.RoundRobinSelector,
+            maxsize=self.maxsize,
+            http_compress=self.http_compress,
+            timeout=self.timeout,
+            serializer=FastJSONSerializer())
+
+    def bulk_writer(self, es, **params):
+        # BulkWriter with the sizes, timeout and retries of this config
+        return BulkWriter(es,
+                          self.bulk_size,
+                          self.bulk_bytes,
+                          timeout=self.bulk_timeout,
+                          max_retries=self.max_retries,
+                          backoff=self.retry_backoff,
+                          adaptive=self.adaptive,
+                          target_latency=self.target_latency,
+                          min_docs=self.min_bulk_size,
+                          max_docs_limit=self.max_bulk_size,
+                          dead_letters=DeadLetterSpool(self.dead_letter_dir)\
+                              if self.dead_letter_dir != None else None,
+                          **params)
+
+# Exact type -> JSON value, faster than an isinstance chain
+JSON_CONVERSIONS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    datetime.date: datetime.date.isoformat,
+    bson.objectid.ObjectId: str,
+    bson.decimal128.Decimal128: lambda value: float(value.to_decimal()),
+    decimal.Decimal: float,
+    uuid.UUID: str
+}
+
+class FastJSONSerializer(elasticsearch.serializer.JSONSerializer):
+    '''
+    Serializer of every request body. It reuses a single compact
+    encoder that keeps ensure_ascii, so Python 2 stays on the C
+    encoder, and it converts BSON and date values by exact type.
+    '''
+    def __init__(self):
+        self.encoder = json.JSONEncoder(default=self.default,
+                                        separators=(',', ':'))
+
+    def default(self, data):
+        convert = JSON_CONVERSIONS.get(type(data))
+        if convert != None:
+            return convert(data)
+
+        return elasticsearch.serializer.JSONSerializer.default(self, data)
+
+    def dumps(self, data):
+        # bodies may already be serialized (e.g. _bulk)
+        if isinstance(data, basestring):
+            return data
+
+        try:
+            return self.encoder.encode(data)
+        except (ValueError, TypeError) as e:
+            raise elasticsearch.exceptions.SerializationError(data, e)
+
+class WatchConfig(object):
+    def __init__(self, state_file='watch.state', max_await_ms='1000'):
+        # where the last acknowledged resume token is kept
+        self.state_file = state_file
+        # how long to wait for changes before flushing a partial batch
+        self.max_await_ms = int(max_await_ms)
+
+class ReportConfig(object):
+    def __init__(self, json_file=None, prometheus_file=None,
+                 profile='false',
+                 sample_file=None,
+                 sample_interval='0.01'):
+        # written at the end of full/sync/update runs, if set
+        self.json_file = json_file
+        # node exporter textfile, replaced atomically
+        self.prometheus_file = prometheus_file
+        # time every stage of the per-document loop (see StageTimer)
+        self.profile = parse_bool(profile)
+        # collapsed stacks of a StackSampler, if set
+        self.sample_file = sample_file
+        self.sample_interval = float(sample_interval)
+
+class RebuildConfig(object):
+    def __init__(self, suffix_format='%Y%m%d%H%M%S',
+                 max_num_segments='1',
+                 merge_timeout='3600',
+                 delete_old='false'):
+        # full --rebuild loads <index name>-<suffix>, then moves the
+        # index name (an alias) to it
+        self.suffix_format = suffix_format
+        # force-merge target and seconds it may take
+        self.max_num_segments = int(max_num_segments)
+        self.merge_timeout = float(merge_timeout)
+        # delete the indices the alias pointed to before
+        self.delete_old = parse_bool(delete_old)
+
+class MappingConfig(object):
+    def __init__(self, dynamic='true', keyword_length='256'):
+        # dynamic setting of installed mappings: true, false or strict
+        self.dynamic = dynamic
+        # longer strings are mapped as text instead of keyword
+        self.keyword_length = int(keyword_length)
+
+class SyncConfig(object):
+    def __init__(self, checkpoint_file=None, doc_as_upsert='false',
+                 hash_file=None):
+        # sqlite file with the checkpoints of sync, None queries
+        # elasticsearch every time
+        self.checkpoint_file = checkpoint_file
+        # sqlite file with the content hashes of indexed documents,
+        # full/update skip the unchanged ones if set
+        self.hash_file = hash_file
+        # update creates missing documents instead of leaving them
+        # for sync
+        self.doc_as_upsert = parse_bool(doc_as_upsert)
+
+class FieldPlan(object):
+    '''
+    Renames document keys with common_field_format. Generated names are
+    memoized by (db, coll, key, value type) and the memo is emptied
+    when it holds more than max_size names. hits, misses and resets
+    count how the memo is doing.
+    '''
+    def __init__(self, field_format, keep, max_size=10000):
+        self.field_format = field_format
+        # keys that are never renamed
+        self.keep = keep
+        self.max_size = max_size
+
+        self.names = dict()
+        self.hits = 0
+        self.misses = 0
+        self.resets = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'resets': self.resets,
+                'size': len(self.names)}
+
+    def new_key(self, db_name, coll_name, key, value_type):
+        plan_key = (db_name, coll_name, key, value_type)
+
+        name = self.names.get(plan_key)
+        if name != None:
+            self.hits += 1
+            return name
+
+        self.misses += 1
+        if len(self.names) >= self.max_size:
+            self.names.clear()
+            self.resets += 1
+
+        name = self.field_format.format(field=key,
+                                        coll=coll_name,
+                                        type=type2str(value_type),
+                                        db=db_name)
+        self.names[plan_key] = name
+        return name
+
+    def apply(self, doc, db_name, coll_name):
+        new_doc = dict()
+        for key, value in doc.iteritems():
+            if key in self.keep:
+                new_doc[key] = value
+                continue
+
+            new_key = self.new_key(db_name, coll_name, key, type(value))
+
+            # If there is an original key with generated name, FAIL!
+            assert not doc.has_key(new_key) and not new_doc.has_key(new_key),\
+                'Generated key already exists: %s' %new_key
+
+            new_doc[new_key] = value
+
+        return new_doc
+
+class AnyTime(object):
+    # Formats as * in index names, matching every time slice
+    def __format__(self, spec):
+        return '*'
+
+ANY_TIME = AnyTime()
+
 class FilterConfig(object):
     def __init__(self, common_timestamp=None,
                  common_field_format=None,
                  sync_field=None,
                  sync_field_inc_suffix='__INC',
                  common_index_format=None,
-                 common_type_format=None):
+                 common_type_format=None,
+                 field_plan_size='10000'):
         
         self.common_timestamp = common_timestamp
         self.common_field_format = common_field_format
@@ -63,19 +367,42 @@ class FilterConfig(object):
         self.common_index_format = common_index_format
         self.common_type_format = common_type_format
 
+        if common_field_format != None:
+            # Fields added by the filters keep their names
+            keep = set([common_timestamp])
+            if sync_field != None:
+                keep.update([sync_field, self.sync_inc_field()])
+            self.field_plan = FieldPlan(common_field_format,
+                                        keep,
+                                        int(field_plan_size))
+        else:
+            self.field_plan = None
+
     def is_default(self):
         return self.common_field_format == None
 
     def sync_inc_field(self):
         return self.sync_field + self.sync_field_inc_suffix
     
-    def get_index_name(self, index):
-        if self.common_index_format == None:
-            return index.index
+    def get_index_name(self, index, ts=None):
+        '''
+        Names may contain date parts of the document time (see
+        doc_time), e.g. {ts:%Y.%m}. Without ts they are replaced by *,
+        so the name matches every time slice.
+        '''
         # if index name is not default, prefer custom
-        elif index.index == index.db_name:
-            return self.common_index_format.format(db=index.db_name,
-                                                   coll=index.coll_name)
+        if self.common_index_format == None or index.index != index.db_name:
+            name_format = index.index
+        else:
+            name_format = self.common_index_format
+
+        return name_format.format(db=index.db_name,
+                                  coll=index.coll_name,
+                                  ts=ts if ts != None else ANY_TIME)
+
+    def is_time_based(self, index):
+        # * is not allowed in index names, see get_index_name
+        return '*' in self.get_index_name(index)
 
     def get_type_name(self, index):
         if self.common_type_format == None:
@@ -86,26 +413,8 @@ class FilterConfig(object):
                                                   coll=index.coll_name)        
 
     def filter_fields(self, doc, db_name, coll_name):
-        keys = doc.keys()
-        for key in keys:
-            if key == self.common_timestamp or\
-               key == self.sync_field or\
-               key == self.sync_inc_field():
-                continue
-            
-            new_key = self.common_field_format\
-                      .format(field=key,
-                              coll=coll_name,
-                              type=type2str(type(doc[key])),
-                              db=db_name)
-
-            # If there is an original key with generated name, FAIL!
-            assert not doc.has_key(new_key), 'Generated key already exists: %s' %new_key
-
-            doc[new_key] = doc[key]
-            del doc[key]
-
-        return doc
+        # Returns a new document, doc is left unchanged
+        return self.field_plan.apply(doc, db_name, coll_name)
 
     def add_common_timestamp_ifset(self, doc, timestamp, tsformat=None):
         if self.common_timestamp == None:
@@ -150,6 +459,18 @@ class FilterConfig(object):
             assert doc.has_key(self.common_timestamp)
             doc[self.sync_field] = doc[self.common_timestamp]
             
+# Python types that map to a single elasticsearch type
+MAPPING_TYPES = {
+    bool: 'boolean',
+    int: 'long',
+    long: 'long',
+    # how pymongo decodes BSON int64
+    bson.int64.Int64: 'long',
+    float: 'double',
+    datetime.datetime: 'date',
+    bson.objectid.ObjectId: 'keyword'
+}
+
 class DynamicMappingSimulation(object):
     class Index(object):
         def __init__(self):
@@ -159,6 +480,46 @@ class DynamicMappingSimulation(object):
         def __init__(self, _type, index_config):
             self.type = _type
             self.index_config = index_config
+            # every collection the field was seen in, each one is
+            # mapped under its own index/type
+            self.index_configs = [index_config]
+            # longest string seen, picks keyword or text
+            self.max_length = 0
+            # type of the first item of lists
+            self.item_type = None
+
+        def observe(self, value, index_config):
+            # documents of a collection come in a row, check the last first
+            if index_config is not self.index_configs[-1] and\
+               index_config not in self.index_configs:
+                self.index_configs.append(index_config)
+
+            if self.type in (str, unicode):
+                self.max_length = max(self.max_length, len(value))
+            elif self.type == list and self.item_type == None and len(value) > 0:
+                self.item_type = type(value[0])
+
+        def mapping(self, keyword_length):
+            '''
+            Elasticsearch mapping of the field, None if the type is
+            better left to dynamic mapping.
+            '''
+            if self.type in (str, unicode):
+                if self.max_length > keyword_length:
+                    return {'type': 'text'}
+                return {'type': 'keyword'}
+
+            if self.type == dict or self.item_type == dict:
+                # Nested documents are kept in _source only
+                return {'type': 'object', 'enabled': False}
+
+            _type = self.item_type if self.type == list else self.type
+            if _type in (str, unicode):
+                return {'type': 'keyword'}
+            if MAPPING_TYPES.has_key(_type):
+                return {'type': MAPPING_TYPES[_type]}
+
+            return None
 
     class ConflictingField(object):
         def __init__(self, name, field):
@@ -178,6 +539,7 @@ class DynamicMappingSimulation(object):
 
             for key in doc.keys():
                 index.fields[key] = DynamicMappingSimulation.Field(type(doc[key]), index_config)
+                index.fields[key].observe(doc[key], index_config)
 
             return None
 
@@ -189,12 +551,958 @@ class DynamicMappingSimulation(object):
                     field = index.fields[key]
                     return DynamicMappingSimulation.ConflictingField(key, field)
 
+                index.fields[key].observe(doc[key], index_config)
                 continue
 
             index.fields[key] = DynamicMappingSimulation.Field(type(doc[key]), index_config)
+            index.fields[key].observe(doc[key], index_config)
 
         # Index existed and types were consistent
         return None
+
+    def mappings(self, filter_config, keyword_length=256):
+        '''
+        Mappings inferred for the simulated documents, as
+        {index name: {type name: {field: mapping}}}.
+        '''
+        mappings = dict()
+        for index in self.indices.values():
+            for key, field in index.fields.items():
+                mapping = field.mapping(keyword_length)
+                if mapping == None:
+                    continue
+
+                for index_config in field.index_configs:
+                    index_name = filter_config.get_index_name(index_config)
+                    type_name = filter_config.get_type_name(index_config)
+                    mappings.setdefault(index_name, dict())\
+                            .setdefault(type_name, dict())[key] = mapping
+
+        return mappings
+
+def put_mappings(es, mappings, dynamic):
+    '''
+    Installs an index template for every index in mappings, and puts
+    the mappings of indices that already exist.
+    '''
+    for index_name, types in mappings.items():
+        body = dict((type_name, {'dynamic': dynamic,
+                                 'properties': properties})
+                    for type_name, properties in types.items())
+
+        es.indices.put_template(name='mongo2elastic-%s' %index_name,
+                                body={'template': index_name,
+                                      'mappings': body})
+
+        if es.indices.exists(index=index_name):
+            for type_name, mapping in body.items():
+                es.indices.put_mapping(index=index_name,
+                                       doc_type=type_name,
+                                       body=mapping)
+
+        print '[ + ] Mappings installed for %s (%s)' %(index_name,
+                                                       ', '.join(body.keys()))
+
+# Index settings while --rebuild loads, restored afterwards
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+# Settings the versioned index copies from the live one (or template)
+REBUILD_COPIED_SETTINGS = ('number_of_shards', 'analysis')
+
+def prepare_rebuild(es, alias, suffix):
+    '''
+    Creates the versioned index of alias with BULK_LOAD_SETTINGS and
+    the mappings and REBUILD_COPIED_SETTINGS of the live index (or of
+    its put_mappings template).
+    Returns its name and the settings to restore, None meaning the
+    elasticsearch default.
+    '''
+    name = '%s-%s' %(alias, suffix)
+    restore = dict((key, None) for key in BULK_LOAD_SETTINGS)
+    body = {'settings': {'index': dict(BULK_LOAD_SETTINGS)}}
+
+    template = 'mongo2elastic-%s' %alias
+    if es.indices.exists(index=alias):
+        # newest index behind the alias, or the index itself
+        source = sorted(es.indices.get(index=alias).items())[-1][1]
+        settings = source['settings']['index']
+        for key in restore:
+            restore[key] = settings.get(key)
+    elif es.indices.exists_template(name=template):
+        source = es.indices.get_template(name=template)[template]
+        settings = source.get('settings', dict()).get('index', dict())
+    else:
+        source = None
+
+    if source != None:
+        body['mappings'] = source['mappings']
+        for key in REBUILD_COPIED_SETTINGS:
+            if settings.has_key(key):
+                body['settings']['index'][key] = settings[key]
+
+    es.indices.create(index=name, body=body)
+    print '[ + ] Rebuilding %s into %s' %(alias, name)
+
+    return name, restore
+
+def finish_rebuild(es, alias, name, restore, rebuild_config):
+    '''
+    Force-merges name, restores its settings and moves alias to it in a
+    single request. If alias was still a plain index (first rebuild),
+    that index is deleted by the same request.
+    '''
+    es.indices.forcemerge(index=name,
+                          max_num_segments=rebuild_config.max_num_segments,
+                          request_timeout=rebuild_config.merge_timeout)
+    es.indices.put_settings(index=name, body={'index': restore})
+    es.indices.refresh(index=name)
+
+    old = []
+    actions = []
+    if es.indices.exists_alias(name=alias):
+        old = es.indices.get_alias(name=alias).keys()
+        actions.extend({'remove': {'index': index, 'alias': alias}}
+                       for index in old)
+    elif es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': name, 'alias': alias}})
+
+    es.indices.update_aliases(body={'actions': actions})
+    print '[ + ] %s now points to %s' %(alias, name)
+
+    if rebuild_config.delete_old:
+        for index in old:
+            es.indices.delete(index=index)
+            print '[ - ] Deleted %s' %index
+
+class BulkWriter(object):
+    '''
+    Buffers actions and sends them to elasticsearch as _bulk requests.
+    A flush is triggered when either max_docs actions or max_bytes of
+    serialized payload have been buffered. Items are reported one by
+    one: results are counted in self.results and failed items are
+    counted in self.failed and either written to dead_letters (a
+    DeadLetterSpool) or kept in self.failures as (action, status,
+    error) tuples.
+
+    With max_in_flight > 1 requests are sent by a thread pool while the
+    caller keeps reading, and add() blocks once max_in_flight requests
+    are pending. Responses are always handled in order, in the calling
+    thread. If tag is set, it is called when a request is sent and its
+    result is passed to on_ack once that request (and all the previous
+    ones) are acknowledged. on_unwritten, if set, is called with the
+    action of every item that failed or was ignored, before the on_ack
+    of its request. close() must be called at the end, it acknowledges
+    a last tag once everything is handled, even if nothing was left to
+    send (e.g. the caller skipped the last documents).
+
+    Items rejected with 429 (or whole requests) are sent again, alone,
+    up to max_retries times waiting backoff seconds, doubled on every
+    retry. A rejected item is dropped instead if a later index or delete
+    of the same document was added meanwhile, since resending it would
+    undo that later action. If adaptive, max_docs (between min_docs and max_docs_limit)
+    and the requests in flight follow the latency of the responses:
+    they grow while responses take less than half of target_latency
+    and shrink when they take longer or items are rejected.
+    '''
+    def __init__(self, es, max_docs=500, max_bytes=10485760, ignore=(),
+                 max_in_flight=1,
+                 tag=None,
+                 on_ack=None,
+                 timeout=None,
+                 max_retries=5,
+                 backoff=0.5,
+                 adaptive=False,
+                 target_latency=1.0,
+                 min_docs=50,
+                 max_docs_limit=5000,
+                 dead_letters=None,
+                 on_unwritten=None):
+        self.es = es
+        # seconds per request, client default if None
+        self.timeout = timeout
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        # statuses that are neither results nor failures (e.g. 404)
+        self.ignore = ignore
+        self.serializer = es.transport.serializer
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_docs = min_docs
+        self.max_docs_limit = max_docs_limit
+
+        self.max_in_flight = max_in_flight
+        # requests allowed in flight, <= max_in_flight
+        self.concurrency = max_in_flight
+        self.tag = tag
+        self.on_ack = on_ack
+        self.on_unwritten = on_unwritten
+        # (actions, payloads, seqs, tag, async result) of pending requests,
+        # oldest first
+        self.in_flight = collections.deque()
+        self.pool = multiprocessing.pool.ThreadPool(max_in_flight)\
+                    if max_in_flight > 1 else None
+
+        # seconds spent in _bulk requests (summed over threads) and
+        # blocked waiting for them, requests in flight summed per flush
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.in_flight_sum = 0
+        self.requests = 0
+        # items sent again after a 429
+        self.retried = 0
+
+        # one action, its (action + source) lines and its sequence number
+        # per buffered item
+        self.actions = []
+        self.payloads = []
+        self.seqs = []
+        self.size = 0
+
+        # bytes buffered since the writer was created
+        self.sent = 0
+
+        self.results = dict()
+        self.failed = 0
+        self.failures = []
+        self.dead_letters = dead_letters
+
+        # sequence number of the last index/delete of every document not
+        # handled yet, see superseded
+        self.seq = 0
+        self.latest = dict()
+
+    def add(self, op_type, index, doc_type, _id, source):
+        action = {op_type: {'_index': index,
+                            '_type': doc_type,
+                            '_id': _id}}
+        payload = self.serializer.dumps(action) + '\n'
+
+        # delete actions have no source line
+        if source != None:
+            payload += self.serializer.dumps(source) + '\n'
+
+        self.append(action, payload)
+
+    def append(self, action, payload):
+        # payload: serialized lines of action (e.g. from dead letters)
+        self.seq += 1
+        if action.keys()[0] in ('index', 'delete'):
+            self.latest[self.key(action)] = self.seq
+
+        self.actions.append(action)
+        self.payloads.append(payload)
+        self.seqs.append(self.seq)
+
+        self.size += len(payload)
+        self.sent += len(payload)
+
+        if len(self.actions) >= self.max_docs or self.size >= self.max_bytes:
+            self.flush()
+
+    def index(self, index, doc_type, _id, doc):
+        self.add('index', index, doc_type, _id, doc)
+
+    def update(self, index, doc_type, _id, doc, upsert=False):
+        # doc may be serialized already (see HashStore)
+        if isinstance(doc, basestring):
+            source = '{"doc":%s%s}' %(doc, ',"doc_as_upsert":true' if upsert else '')
+        else:
+            source = {'doc': doc}
+            if upsert:
+                source['doc_as_upsert'] = True
+        self.add('update', index, doc_type, _id, source)
+
+    def delete(self, index, doc_type, _id):
+        self.add('delete', index, doc_type, _id, None)
+
+    def flush(self):
+        if len(self.actions) == 0:
+            return
+
+        actions = self.actions
+        payloads = self.payloads
+        seqs = self.seqs
+        body = ''.join(payloads)
+        tag = self.tag() if self.tag != None else None
+
+        self.actions = []
+        self.payloads = []
+        self.seqs = []
+        self.size = 0
+
+        self.requests += 1
+
+        if self.pool == None:
+            self.handle(actions, payloads, seqs, self.send(body), tag)
+            return
+
+        # Backpressure, wait for the oldest requests
+        start = time.time()
+        self.wait(self.concurrency - 1)
+        self.blocked += time.time() - start
+
+        self.in_flight.append((actions,
+                               payloads,
+                               seqs,
+                               tag,
+                               self.pool.apply_async(self.send, (body,))))
+        self.in_flight_sum += len(self.in_flight)
+
+        # Handle whatever is already done
+        self.wait(self.concurrency)
+
+    def send(self, body):
+        '''
+        Returns the response (None if the whole request was rejected
+        with 429) and the seconds it took.
+        '''
+        start = time.time()
+        try:
+            if self.timeout != None:
+                response = self.es.bulk(body=body, request_timeout=self.timeout)
+            else:
+                response = self.es.bulk(body=body)
+        except elasticsearch.TransportError as e:
+            if e.status_code != 429:
+                raise
+            response = None
+
+        seconds = time.time() - start
+        # float += is atomic enough for stats under the GIL
+        self.busy += seconds
+
+        return response, seconds
+
+    def wait(self, limit=0):
+        '''
+        Handles finished requests in order, blocking until at most
+        limit requests are in flight.
+        '''
+        while len(self.in_flight) > 0:
+            actions, payloads, seqs, tag, result = self.in_flight[0]
+            if len(self.in_flight) <= limit and not result.ready():
+                return
+
+            self.in_flight.popleft()
+            self.handle(actions, payloads, seqs, result.get(), tag)
+
+    def close(self):
+        # Sends what is left and waits for every response
+        self.flush()
+        start = time.time()
+        self.wait()
+        self.blocked += time.time() - start
+
+        if self.on_ack != None:
+            self.on_ack(self.tag() if self.tag != None else None)
+
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        if self.dead_letters != None:
+            self.dead_letters.close()
+
+    def handle(self, actions, payloads, seqs, sent, tag):
+        batch = zip(actions, seqs)
+        response, seconds = sent
+        rejected = self.record(actions, payloads, response)
+        self.adapt(seconds, len(rejected) > 0)
+
+        retry = 0
+        while len(rejected) > 0 and retry < self.max_retries:
+            time.sleep(self.backoff * 2 ** retry)
+            retry += 1
+
+            # later actions of the same document were applied already
+            kept = [i for i in rejected
+                    if not self.superseded(actions[i], seqs[i])]
+            self.results['superseded'] = self.results.get('superseded', 0) +\
+                                         len(rejected) - len(kept)
+            if len(kept) == 0:
+                rejected = kept
+                break
+
+            actions = [actions[i] for i in kept]
+            payloads = [payloads[i] for i in kept]
+            seqs = [seqs[i] for i in kept]
+            self.retried += len(actions)
+
+            response, seconds = self.send(''.join(payloads))
+            rejected = self.record(actions, payloads, response)
+            self.adapt(seconds, len(rejected) > 0)
+
+        for i in rejected:
+            self.fail(actions[i],
+                      payloads[i],
+                      429,
+                      'rejected after %d retries' %retry)
+
+        for action, seq in batch:
+            key = self.key(action)
+            if self.latest.get(key) == seq:
+                del self.latest[key]
+
+        if self.dead_letters != None:
+            self.dead_letters.flush()
+
+        if self.on_ack != None:
+            self.on_ack(tag)
+
+    def key(self, action):
+        meta = action.values()[0]
+        return meta['_index'], meta['_type'], meta['_id']
+
+    def superseded(self, action, seq):
+        # True if an index/delete of the same document was added after
+        # the action with sequence number seq
+        return self.latest.get(self.key(action), 0) > seq
+
+    def fail(self, action, payload, status, error):
+        self.failed += 1
+        if self.on_unwritten != None:
+            self.on_unwritten(action)
+        if self.dead_letters != None:
+            self.dead_letters.write(action, payload, status, error)
+        else:
+            self.failures.append((action, status, error))
+
+    def record(self, actions, payloads, response):
+        # Returns the positions of the rejected (429) items
+        if response == None:
+            return range(len(actions))
+
+        rejected = []
+        for i, (action, item) in enumerate(zip(actions, response['items'])):
+            # item: {op_type: {'status': ..., 'result': ..., 'error': ...}}
+            info = item.values()[0]
+            status = info.get('status')
+
+            if status in self.ignore:
+                if self.on_unwritten != None:
+                    self.on_unwritten(action)
+                continue
+
+            if status == 429:
+                rejected.append(i)
+                continue
+
+            if 'error' in info:
+                self.fail(action, payloads[i], status, info['error'])
+                continue
+
+            result = info.get('result')
+            self.results[result] = self.results.get(result, 0) + 1
+
+        return rejected
+
+    def adapt(self, seconds, rejected):
+        if not self.adaptive:
+            return
+
+        if rejected:
+            self.max_docs = max(self.min_docs, self.max_docs // 2)
+            self.concurrency = max(1, self.concurrency - 1)
+        elif seconds > self.target_latency:
+            self.max_docs = max(self.min_docs, int(self.max_docs * 0.8))
+        elif seconds < self.target_latency / 2:
+            self.max_docs = min(self.max_docs_limit, int(self.max_docs * 1.25) + 1)
+            self.concurrency = min(self.max_in_flight, self.concurrency + 1)
+
+class DeadLetterSpool(object):
+    '''
+    Append-only gzip files with the items elasticsearch rejected, one
+    per index and spool (so --jobs workers never share a file) in
+    directory. Every line is a JSON object with the bulk payload of the
+    item, its status and error. Files are written as *.jsonl.gz.part
+    and renamed to *.jsonl.gz by close(), so replay() only reads
+    complete files that nobody writes anymore. See replay().
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        # index -> (open file, path without .part)
+        self.files = dict()
+
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Already there (maybe created by another worker)
+            if not os.path.isdir(directory):
+                raise
+
+    def write(self, action, payload, status, error):
+        index = action.values()[0]['_index']
+
+        if not self.files.has_key(index):
+            path = os.path.join(self.directory,
+                                '%s.%d.%s.jsonl.gz' %(index,
+                                                      os.getpid(),
+                                                      uuid.uuid4().hex[:8]))
+            self.files[index] = (gzip.open(path + '.part', 'wb'), path)
+
+        self.files[index][0].write(json.dumps({'payload': payload,
+                                            'status': status,
+                                            'error': error,
+                                            'time': time.time()}) + '\n')
+
+    def flush(self):
+        for f, path in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f, path in self.files.values():
+            f.close()
+            os.rename(path + '.part', path)
+        self.files = dict()
+
+def replay(es_config, es):
+    '''
+    Sends the items of every closed dead letter file again, in bulk
+    (*.jsonl.gz.part files of running indexers are left alone). Files
+    are claimed by renaming them and removed once all their items are
+    acknowledged. Items that are rejected again go to new files. If
+    the replay fails, claimed files get their names back; files left
+    claimed by a replay that died are picked up too.
+    '''
+    pattern = os.path.join(es_config.dead_letter_dir, '*.jsonl.gz')
+    claimed = glob.glob(pattern + '.replay')
+    for path in glob.glob(pattern):
+        os.rename(path, path + '.replay')
+        claimed.append(path + '.replay')
+    claimed.sort()
+
+    writer = es_config.bulk_writer(es)
+    replayed = 0
+
+    try:
+        for path in claimed:
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    # payloads are ASCII, see FastJSONSerializer
+                    payload = json.loads(line)['payload'].encode('utf-8')
+                    action = json.loads(payload.split('\n', 1)[0])
+                    writer.append(action, payload)
+                    replayed += 1
+
+        writer.close()
+    except:
+        # Items already sent are sent again next time, which is harmless
+        for path in claimed:
+            original = path[:-len('.replay')]
+            if not os.path.exists(original):
+                os.rename(path, original)
+        raise
+
+    for path in claimed:
+        os.remove(path)
+
+    print 'Replayed %d documents from %d files, %d rejected again.' %(replayed,
+                                                                     len(claimed),
+                                                                     writer.failed)
+    print_failures(writer.failures)
+
+# Stages of the per-document loop, in order (see StageTimer)
+PROFILE_STAGES = ('read', 'script', 'timestamps', 'fields', 'hash', 'check',
+                  'write', 'elasticsearch')
+
+class StageTimer(object):
+    '''
+    Seconds and calls of each stage of the per-document loop. lap(stage)
+    charges the time since the previous lap to stage, so stages that
+    run back to back cost a single clock read each.
+    '''
+    def __init__(self):
+        self.seconds = dict()
+        self.calls = dict()
+        self.last = time.time()
+
+    def start(self):
+        self.last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.add(stage, now - self.last)
+        self.last = now
+
+    def add(self, stage, seconds, calls=1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def stats(self):
+        # {stage: [seconds, calls]}, plain data for CollectionReport
+        return dict((stage, [self.seconds[stage], self.calls[stage]])
+                    for stage in self.seconds)
+
+class StackSampler(threading.Thread):
+    '''
+    Sampling profiler. Every interval seconds it records the stack of
+    every other thread of this process; write() saves them as collapsed
+    stacks ("outer;inner count" lines), as read by flamegraph.pl and
+    speedscope.
+    '''
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stacks = dict()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' %(code.co_name,
+                                                os.path.basename(code.co_filename),
+                                                code.co_firstlineno))
+                    frame = frame.f_back
+
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' %(stack, count))
+
+def partition_id_ranges(coll, partitions):
+    '''
+    Splits the ObjectId keyspace of coll into (at most) partitions
+    ranges of equal generation time span. Returns a list of _id
+    conditions for find(), or [None] if coll can not be partitioned.
+    '''
+    first = coll.find_one(sort=[('_id', pymongo.ASCENDING)])
+    last = coll.find_one(sort=[('_id', pymongo.DESCENDING)])
+
+    if partitions < 2 or first == None or\
+       type(first['_id']) != bson.objectid.ObjectId or\
+       type(last['_id']) != bson.objectid.ObjectId:
+        return [None]
+
+    start = first['_id'].generation_time
+    span = last['_id'].generation_time - start
+    step = span // partitions
+
+    # ObjectId timestamps have second resolution
+    if step < datetime.timedelta(seconds=1):
+        return [None]
+
+    bounds = [bson.objectid.ObjectId.from_datetime(start + step * n)
+              for n in range(1, partitions)]
+
+    ranges = [{'$lt': bounds[0]}]
+    for lower, upper in zip(bounds, bounds[1:]):
+        ranges.append({'$gte': lower, '$lt': upper})
+    ranges.append({'$gte': bounds[-1]})
+
+    return ranges
+
+class UpdateChecker(object):
+    '''
+    --test counterpart of the bulk updates: looks documents up with
+    _mget, batch_size at a time, and counts in self.behind how many of
+    them an update would change. Only the fields of the new document
+    are fetched. Documents that are not indexed are left for sync.
+    '''
+    def __init__(self, es, batch_size=500, timeout=None):
+        self.es = es
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        self.docs = []
+        self.key_counts = []
+
+        self.behind = 0
+        self.failures = []
+
+    def check(self, index, doc_type, _id, doc):
+        self.docs.append({'_index': index,
+                          '_type': doc_type,
+                          '_id': _id,
+                          '_source': doc.keys()})
+        self.key_counts.append(len(doc))
+
+        if len(self.docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.docs) == 0:
+            return
+
+        docs = self.docs
+        key_counts = self.key_counts
+
+        self.docs = []
+        self.key_counts = []
+
+        if self.timeout != None:
+            response = self.es.mget(body={'docs': docs},
+                                    request_timeout=self.timeout)
+        else:
+            response = self.es.mget(body={'docs': docs})
+
+        for meta, key_count, found in zip(docs, key_counts, response['docs']):
+            if 'error' in found:
+                self.failures.append(({'get': meta}, None, found['error']))
+                continue
+
+            # element not found - leave for sync
+            if not found['found']:
+                continue
+
+            # naive criterion: some field is missing
+            if len(found['_source']) != key_count:
+                self.behind += 1
+
+# Checkpoints are compared with documents read by pymongo (naive UTC)
+CHECKPOINT_JSON_OPTIONS = bson.json_util.JSONOptions(tz_aware=False)
+
+class CheckpointStore(object):
+    '''
+    Keeps the highest acknowledged _id and timestamp of every db.coll
+    in a SQLite file, so sync does not have to find them with a sorted
+    search on elasticsearch, and the updated_field watermark of update.
+    '''
+    def __init__(self, path):
+        # Autocommit, transactions are explicit (see advance)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoints '
+                          '(name TEXT PRIMARY KEY, checkpoint TEXT)')
+
+    def get(self, index):
+        row = self.conn.execute('SELECT checkpoint FROM checkpoints WHERE name = ?',
+                                ('%s.%s' %(index.db_name, index.coll_name),)).fetchone()
+        if row == None:
+            return None
+
+        return bson.json_util.loads(row[0], json_options=CHECKPOINT_JSON_OPTIONS)
+
+    def advance(self, index, checkpoint):
+        '''
+        Merges checkpoint into the stored one. Values only move
+        forward, since partitions may finish in any order.
+        '''
+        if len(checkpoint) == 0:
+            return
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = self.get(index) or dict()
+            for key, value in checkpoint.items():
+                if not current.has_key(key) or value > current[key]:
+                    current[key] = value
+
+            self.conn.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?)',
+                              ('%s.%s' %(index.db_name, index.coll_name),
+                               bson.json_util.dumps(current)))
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+class HashStore(object):
+    '''
+    Content hash of the last acknowledged version of every document,
+    by index name and _id, in a SQLite file. Documents whose
+    serialized output hashes the same are not sent again. Hashes are
+    only compared, so a different key order just means a resend.
+    '''
+    def __init__(self, path):
+        # Autocommit, transactions are explicit (see put)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS hashes '
+                          '(name TEXT, id TEXT, hash INTEGER, '
+                          'PRIMARY KEY (name, id))')
+
+    def digest(self, source):
+        # source: serialized document, 64 bits of its md5
+        return struct.unpack('<q', hashlib.md5(source).digest()[:8])[0]
+
+    def get(self, name, _id):
+        row = self.conn.execute('SELECT hash FROM hashes WHERE name = ? AND id = ?',
+                                (name, _id)).fetchone()
+        return row[0] if row != None else None
+
+    def put(self, hashes):
+        # hashes: (index name, _id, digest) tuples
+        if len(hashes) == 0:
+            return
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                                  hashes)
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+def track_checkpoint(checkpoint, index, doc, update=False):
+    # Must be called before transform_doc, it needs the original fields
+    if update:
+        # update only moves its own watermark, _id and timestamp are
+        # those of sync
+        if doc.has_key(index.updated_field):
+            updated = doc[index.updated_field]
+            if not checkpoint.has_key('updated') or updated > checkpoint['updated']:
+                checkpoint['updated'] = updated
+        return
+
+    object_id = doc['_id']
+    if type(object_id) == bson.objectid.ObjectId and\
+       (not checkpoint.has_key('_id') or object_id > checkpoint['_id']):
+        checkpoint['_id'] = object_id
+
+    if index.timestamp != None and doc.has_key(index.timestamp):
+        ts = doc[index.timestamp]
+        if not checkpoint.has_key('timestamp') or ts > checkpoint['timestamp']:
+            checkpoint['timestamp'] = ts
+
+def format_stages(stages):
+    average = lambda total, samples: float(total) / samples if samples > 0 else 0
+
+    return 'read {0:.1f}s, transform {1:.1f}s, write {2:.1f}s, '\
+           'read queue {3:.1f} chunks, in flight {4:.1f} requests'.format(
+               stages['read'],
+               stages['transform'],
+               stages['write'],
+               average(stages['read_queue'], stages['read_samples']),
+               average(stages['in_flight'], stages['requests']))
+
+def format_profile(profile):
+    # profile: {stage: [seconds, calls]}, see StageTimer.stats
+    average = lambda seconds, calls: 1e6 * seconds / calls if calls > 0 else 0
+
+    return ', '.join('{0} {1:.1f}s ({2:.1f}us)'.format(stage,
+                                                     profile[stage][0],
+                                                     average(*profile[stage]))
+                     for stage in PROFILE_STAGES
+                     if profile.has_key(stage))
+
+def format_field_plan(stats):
+    lookups = stats['hits'] + stats['misses']
+    return 'field names: {0:.1f}% memoized, {1} misses, {2} resets, '\
+           '{3} names'.format(100.0 * stats['hits'] / lookups if lookups > 0 else 0,
+                              stats['misses'],
+                              stats['resets'],
+                              stats['size'])
+
+def collection_summary(index, filter_config, report):
+    # JSON-ready outcome of a collection, see write_json_report
+    return {'collection': index.db_name + '.' + index.coll_name,
+            'index': filter_config.get_index_name(index) + '/' +\
+                     filter_config.get_type_name(index),
+            'status': report.status,
+            'nothing_to_do': report.nothing_to_do,
+            'done': report.done,
+            'total': report.total,
+            'updated': report.updated,
+            'unchanged': report.unchanged,
+            'failed': report.failed,
+            'bytes': report.size,
+            'elapsed': report.elapsed,
+            'docs_per_second': report.done / report.elapsed\
+                               if report.elapsed > 0 else 0.0,
+            'profile': report.profile,
+            'field_plan': report.field_plan,
+            'stages': report.stages}
+
+def write_json_report(path, run):
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+
+def write_prometheus(path, run):
+    '''
+    Writes the run (see main) as a node exporter textfile. It is
+    replaced atomically, so the exporter never reads half of it.
+    '''
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append('# HELP mongo2elastic_%s %s' %(name, help_text))
+        lines.append('# TYPE mongo2elastic_%s gauge' %name)
+        for labels, value in samples:
+            label_text = ','.join('%s="%s"' %(key, str(value).replace('\\', '\\\\')
+                                                          .replace('"', '\\"'))
+                                  for key, value in sorted(labels.items()))
+            lines.append('mongo2elastic_%s{%s} %r' %(name, label_text, float(value)))
+
+    mode = {'mode': run['mode']}
+    metric('last_run_timestamp_seconds', 'End of the last run.',
+           [(mode, run['started'] + run['elapsed'])])
+    metric('run_duration_seconds', 'Duration of the last run.',
+           [(mode, run['elapsed'])])
+    metric('run_docs', 'Documents read in the last run.',
+           [(mode, run['docs'])])
+    metric('run_failed_docs', 'Documents rejected in the last run.',
+           [(mode, run['failed'])])
+
+    collections = [(dict(mode, collection=summary['collection']), summary)
+                   for summary in run['collections']]
+    metric('collection_docs', 'Documents read per collection.',
+           [(labels, summary['done']) for labels, summary in collections])
+    metric('collection_docs_per_second', 'Documents per second per collection.',
+           [(labels, summary['docs_per_second']) for labels, summary in collections])
+    metric('collection_failed_docs', 'Documents rejected per collection.',
+           [(labels, summary['failed']) for labels, summary in collections])
+    metric('collection_unchanged_docs', 'Documents skipped as unchanged per collection.',
+           [(labels, summary['unchanged']) for labels, summary in collections])
+    metric('collection_duration_seconds', 'Seconds spent per collection.',
+           [(labels, summary['elapsed']) for labels, summary in collections])
+
+    plans = [(labels, summary['field_plan']) for labels, summary in collections
+             if summary['field_plan'] != None]
+    if len(plans) > 0:
+        metric('field_plan_hits', 'Field names found in the FieldPlan memo.',
+               [(labels, plan['hits']) for labels, plan in plans])
+        metric('field_plan_misses', 'Field names generated by the FieldPlan.',
+               [(labels, plan['misses']) for labels, plan in plans])
+        metric('field_plan_resets', 'Times the FieldPlan memo was emptied.',
+               [(labels, plan['resets']) for labels, plan in plans])
+
+    stages = [(dict(labels, stage=stage), seconds, calls)
+              for labels, summary in collections
+              if summary['profile'] != None
+              for stage, (seconds, calls) in sorted(summary['profile'].items())]
+    if len(stages) > 0:
+        metric('stage_seconds', 'Seconds spent per stage (profile=true).',
+               [(labels, seconds) for labels, seconds, calls in stages])
+        metric('stage_calls', 'Calls per stage (profile=true).',
+               [(labels, calls) for labels, seconds, calls in stages])
+        metric('stage_latency_seconds', 'Average seconds per call of each stage.',
+               [(labels, seconds / calls if calls > 0 else 0.0)
+                for labels, seconds, calls in stages])
+
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp_file, path)
+
+def print_failures(failures):
+    for action, status, error in failures:
+        meta = action.values()[0]
+        print '[ERROR] %s/%s/%s (%s): %s' %(meta['_index'],
+                                            meta['_type'],
+                                            meta['_id'],
+                                            status,
+                                            error)
             
 def make_params(config, section, *param_names):
     params = dict()
@@ -210,51 +1518,186 @@ def type2str(t):
     return str(t).replace("<type '", '').replace("'>", '')
 
 def print_title():
-    title = '{0: <9} {1: <40} {2: <40} {3: <20} {4: >20}'.format('%',
-                                                                 'DB.COLLECTION',
-                                                                 'INDEX/TYPE',
-                                                                 'DOCS',
-                                                                 'STATUS')
+    title = '{0: <9} {1: <40} {2: <40} {3: <20} {4: >20} {5: <40}'.format('%',
+                                                                         'DB.COLLECTION',
+                                                                         'INDEX/TYPE',
+                                                                         'DOCS',
+                                                                         'STATUS',
+                                                                         'RATE')
     print title
     print '=' * len(title)
 
-def print_progress(index, filter_config, i, total, status):
-    prog_per = str('{0:.2f}'.format(float(i)/total*100))
-    prog_raw = str(i) + '/' + str(total)
+def format_rate(done, size, elapsed, total=None):
+    if elapsed <= 0:
+        return ''
+
+    rate = done / elapsed
+    text = '%d docs/s' %rate
+    if size > 0:
+        text += ' %.2f MB/s' %(size / elapsed / 1048576)
+    if total != None and rate > 0 and total > done:
+        text += ' ETA %s' %datetime.timedelta(seconds=int((total - done) / rate))
+
+    return text
+
+def print_progress(index, filter_config, i, total, status, rate=''):
     from_txt = index.db_name + '.' + index.coll_name
     dest_txt = filter_config.get_index_name(index) + '/' +\
                filter_config.get_type_name(index)
+
+    write_progress(from_txt, dest_txt, i, total, status, rate)
+
+def write_progress(from_txt, dest_txt, i, total, status, rate):
+    # total is None while unknown
+    if total == None:
+        prog_per = '?'
+        prog_raw = str(i) + '/?'
+    else:
+        prog_per = str('{0:.2f}'.format(float(i)/total*100))
+        prog_raw = str(i) + '/' + str(total)
     
-    sys.stdout.write('[{0: >6}%] {1: <40} {2: <40} {3: <20} {4: >20}\r'.format(prog_per,
-                                                                            from_txt,
-                                                                            dest_txt,
-                                                                            prog_raw,
-                                                                            status))
+    sys.stdout.write('[{0: >6}%] {1: <40} {2: <40} {3: <20} {4: >20} {5: <40}\r'.format(prog_per,
+                                                                                     from_txt,
+                                                                                     dest_txt,
+                                                                                     prog_raw,
+                                                                                     status,
+                                                                                     rate))
     
     sys.stdout.flush()
+
+class Progress(object):
+    '''
+    Progress line of a collection. update() is meant to be called for
+    every document, but the line is redrawn at most once per interval
+    seconds, along with docs/s, MB/s and the ETA.
+    '''
+    def __init__(self, index, filter_config, report, interval=0.5, verbose=True):
+        self.from_txt = index.db_name + '.' + index.coll_name
+        self.dest_txt = filter_config.get_index_name(index) + '/' +\
+                        filter_config.get_type_name(index)
+        self.report = report
+        self.interval = interval
+        self.verbose = verbose
+
+        self.start = time.time()
+        self.next_draw = self.start
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def update(self, status, size=0):
+        # size: bytes sent so far
+        if not self.verbose:
+            return
+
+        now = time.time()
+        if now < self.next_draw:
+            return
+        self.next_draw = now + self.interval
+
+        report = self.report
+        write_progress(self.from_txt,
+                       self.dest_txt,
+                       report.done,
+                       report.total,
+                       status,
+                       format_rate(report.done, size, now - self.start, report.total))
     
 def usage():
-    print 'Usage: ', sys.argv[0], '[--test] [full|sync|update] config_file'
+    print 'Usage: ', sys.argv[0], '[--test [--put-mappings]] [--rebuild] [--jobs N] [--interval SECONDS] [--no-count] [--engine sync|overlap|pipeline] [full|sync|update|watch|replay] config_file'
     sys.exit(1)
 
-# TODO: sync support
-    
-def main():
-    optparser = optparse.OptionParser()
-    optparser.add_option('-t', '--test',
-                         action='store_true',
-                         dest='test',
-                         default=False)
-    opts, args = optparser.parse_args()
-    
-    if len(args) != 2:
-        usage()
-
-    if args[0] not in ('full', 'sync', 'update'):
-        usage()        
+class CollectionReport(object):
+    '''
+    Outcome of indexing one collection. It only holds plain data so it
+    can be sent back from a worker process.
+    '''
+    def __init__(self, position):
+        # position of the collection in the configured indices
+        self.position = position
+        self.done = 0
+        self.total = 0
+        # bytes sent and seconds spent
+        self.size = 0
+        self.elapsed = 0
+        # stage statistics of --engine pipeline
+        self.stages = None
+        # {stage: [seconds, calls]} if profiled, see StageTimer
+        self.profile = None
+        # FieldPlan hits, misses and resets of this collection and the
+        # memo size at its end, None without common_field_format
+        self.field_plan = None
+        self.status = None
+        self.nothing_to_do = False
+        self.updated = 0
+        # documents skipped because their hash did not change
+        self.unchanged = 0
+        # failures are only kept here if there is no dead letter spool
+        self.failed = 0
+        self.failures = []
+        self.conflicting_field = None
+
+    def merge(self, other):
+        # Adds up the report of another partition of the same collection
+        self.done += other.done
+        self.total += other.total
+        self.size += other.size
+        # partitions run at the same time
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+        if other.stages != None:
+            if self.stages == None:
+                self.stages = dict()
+            for key, value in other.stages.items():
+                self.stages[key] = self.stages.get(key, 0) + value
+
+        if other.field_plan != None:
+            if self.field_plan == None:
+                self.field_plan = dict(other.field_plan)
+            else:
+                for key in ('hits', 'misses', 'resets'):
+                    self.field_plan[key] += other.field_plan[key]
+                self.field_plan['size'] = max(self.field_plan['size'],
+                                              other.field_plan['size'])
+
+        if other.profile != None:
+            if self.profile == None:
+                self.profile = dict()
+            for stage, (seconds, calls) in other.profile.items():
+                total = self.profile.setdefault(stage, [0.0, 0])
+                total[0] += seconds
+                total[1] += calls
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+        self.failed += other.failed
+        self.failures.extend(other.failures)
+        self.nothing_to_do = self.nothing_to_do and other.nothing_to_do
+
+    def set_status(self, update, test):
+        if self.failed > 0:
+            self.status = '%d DOCS FAILED' %self.failed
+        elif test:
+            if update:
+                if self.updated > 0:
+                    self.status = 'BEHIND BY %d DOCS' %self.updated
+                else:
+                    self.status = 'UP TO DATE'
+            else:
+                self.status = 'OK'
+        else:
+            if update:
+                if self.updated > 0:
+                    self.status = '%d DOCS UPDATED' %self.updated
+                else:
+                    self.status = 'UP TO DATE'
+            elif self.unchanged > 0:
+                self.status = 'INDEXED, %d UNCHANGED' %self.unchanged
+            else:
+                self.status = 'INDEXED'
 
+def read_config(config_path):
     config = ConfigParser.RawConfigParser()
-    config.read(args[1])
+    config.read(config_path)
 
     es_config = ElasticsearchConfig(**make_params(
         config,
@@ -262,32 +1705,55 @@ def main():
         'user',
         'password',
         'uri',
-        'port'))\
+        'port',
+        'bulk_size',
+        'bulk_bytes',
+        'mget_size',
+        'max_in_flight',
+        'hosts',
+        'maxsize',
+        'http_compress',
+        'timeout',
+        'bulk_timeout',
+        'search_timeout',
+        'max_retries',
+        'retry_backoff',
+        'adaptive',
+        'target_latency',
+        'min_bulk_size',
+        'max_bulk_size',
+        'dead_letter_dir'))\
         if 'elasticsearch' in config.sections()\
         else ElasticsearchConfig()
 
-    # Initialize Mongo client
-    mongo_client = pymongo.MongoClient()
-
-    # Initialize elasticsearch client
-    es = elasticsearch.Elasticsearch(es_config.get_uri())
-
     # Get (db_namef, coll_name) pairs
     targets = [tuple(target.split(':')[1].split('.'))
                for target in config.sections()
                if target.startswith('index:')]
 
+    # Cursor options of every index, unless overriden
+    cursor_params = ('batch_size', 'exhaust', 'reopen', 'read_ahead')
+    mongo_params = make_params(config, 'mongo', *cursor_params)
+
     # Get collections to index
     indices = []
     for target in targets:
         section = 'index:%s.%s' %target
-        params = make_params(config,
-                             section,
-                             'timestamp',
-                             'index',
-                             'type',
-                             'tsformat',
-                             'script')
+        params = dict(mongo_params)
+        params.update(make_params(config,
+                                  section,
+                                  'timestamp',
+                                  'index',
+                                  'type',
+                                  'tsformat',
+                                  'script',
+                                  'partitions',
+                                  'query',
+                                  'projection',
+                                  'pipeline',
+                                  'script_batch_size',
+                                  'updated_field',
+                                  *cursor_params))
         indices.append(IndexConfig(*target,
                                    **params))
 
@@ -300,272 +1766,1263 @@ def main():
         'sync_field',
         'sync_field_inc_suffix',
         'common_index_format',
-        'common_type_format'))
+        'common_type_format',
+        'field_plan_size'))
 
-    # is this a simulation?
-    test = opts.test
+    watch_config = WatchConfig(**make_params(
+        config,
+        'watch',
+        'state_file',
+        'max_await_ms'))
+
+    sync_config = SyncConfig(**make_params(
+        config,
+        'sync',
+        'checkpoint_file',
+        'doc_as_upsert',
+        'hash_file'))
+
+    mapping_config = MappingConfig(**make_params(
+        config,
+        'mapping',
+        'dynamic',
+        'keyword_length'))
+
+    report_config = ReportConfig(**make_params(
+        config,
+        'report',
+        'json_file',
+        'prometheus_file',
+        'profile',
+        'sample_file',
+        'sample_interval'))
+
+    rebuild_config = RebuildConfig(**make_params(
+        config,
+        'rebuild',
+        'suffix_format',
+        'max_num_segments',
+        'merge_timeout',
+        'delete_old'))
+
+    return es_config, indices, filter_config, watch_config, sync_config,\
+        mapping_config, report_config, rebuild_config
+
+def transform_doc(index, filter_config, doc, filtered=False, timer=None):
+    '''
+    Applies the collection script (unless filtered already, see
+    filter_batches) and the common filters to doc. Returns the
+    elasticsearch id and the resulting document. Stages are charged
+    to timer (a StageTimer), if set.
+    '''
+    object_id = doc['_id']
+    _id = str(object_id)
+    del doc['_id']
+
+    if not filtered:
+        index.filter_fn(doc)
+        if timer != None:
+            timer.lap('script')
+
+    # Add a common timestamp field if set in filters
+    filter_config.add_common_timestamp_ifset(doc,
+                                             index.timestamp,
+                                             index.tsformat)
+
+    # Add a sync timestamp field if set in filters
+    filter_config.add_sync_field_ifset(doc, object_id)
+
+    if timer != None:
+        timer.lap('timestamps')
+
+    if not filter_config.is_default():
+        doc = filter_config.filter_fields(doc,
+                                          index.db_name,
+                                          index.coll_name)
+        if timer != None:
+            timer.lap('fields')
+
+    return _id, doc
+
+def doc_time(filter_config, doc, object_id):
+    '''
+    Time of a transformed document in time-based index names: its
+    common timestamp, or else the generation time of its ObjectId.
+    '''
+    if filter_config.common_timestamp != None:
+        ts = doc.get(filter_config.common_timestamp)
+        if isinstance(ts, datetime.datetime):
+            return ts
+
+    assert type(object_id) == bson.objectid.ObjectId,\
+        'No time for a time-based index name: %s' %object_id
+    return object_id.generation_time
+
+def newest_index(es, pattern):
+    # Time slices sort by name if their date parts do (e.g. %Y.%m)
+    names = sorted(es.indices.get_alias(index=pattern).keys())
+    return names[-1] if len(names) > 0 else None
+
+def find(coll, index, condition=None, sort=None):
+    '''
+    Reads coll with the query, projection and pipeline of index, all
+    run on the server. condition (sync, partitions) is added to the
+    query and sort ((key, direction) pairs) is applied before the
+    pipeline. Documents coming out of a pipeline must keep their _id.
+    '''
+    if index.query != None and condition != None:
+        match = {'$and': [index.query, condition]}
+    else:
+        match = index.query or condition or dict()
+
+    if index.pipeline == None:
+        # ReopeningCursor has its own order
+        if sort != None:
+            return open_cursor(coll, index, match).sort(sort)
+        if index.reopen:
+            return ReopeningCursor(coll, index, match)
+        return open_cursor(coll, index, match)
+
+    stages = []
+    if len(match) > 0:
+        stages.append({'$match': match})
+    if sort != None:
+        stages.append({'$sort': bson.son.SON(sort)})
+    if index.projection != None:
+        stages.append({'$project': index.projection})
+
+    options = dict()
+    if index.batch_size > 0:
+        options['batchSize'] = index.batch_size
+
+    return coll.aggregate(stages + index.pipeline, allowDiskUse=True, **options)
+
+def open_cursor(coll, index, match):
+    options = dict()
+    if index.exhaust:
+        options['cursor_type'] = pymongo.CursorType.EXHAUST
+
+    cursor = coll.find(match, index.projection, **options)
+    if index.batch_size > 0:
+        cursor.batch_size(index.batch_size)
+
+    return cursor
+
+class CursorReader(threading.Thread):
+    '''
+    Drains a cursor from a thread into a bounded queue, chunk_size
+    documents at a time, so the next batches are fetched while the
+    current one is transformed. Iterating the reader starts it. busy is
+    the time spent reading, wait the time the consumer spent waiting
+    for documents and depth_sum/samples the average queue depth.
+    '''
+    def __init__(self, cursor, read_ahead=1000, chunk_size=100):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.cursor = cursor
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max(1, read_ahead // chunk_size))
+        self.error = None
+
+        self.busy = 0.0
+        self.wait = 0.0
+        self.depth_sum = 0
+        self.samples = 0
+
+    def run(self):
+        try:
+            chunk = []
+            start = time.time()
+            for doc in self.cursor:
+                chunk.append(doc)
+                if len(chunk) >= self.chunk_size:
+                    self.busy += time.time() - start
+                    self.queue.put(chunk)
+                    chunk = []
+                    start = time.time()
+
+            self.busy += time.time() - start
+            if len(chunk) > 0:
+                self.queue.put(chunk)
+
+        except Exception:
+            self.error = sys.exc_info()
+
+        finally:
+            # End of cursor
+            self.queue.put(None)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            self.depth_sum += self.queue.qsize()
+            self.samples += 1
+
+            start = time.time()
+            chunk = self.queue.get()
+            self.wait += time.time() - start
+
+            if chunk == None:
+                break
+
+            for doc in chunk:
+                yield doc
+
+        if self.error != None:
+            raise self.error[0], self.error[1], self.error[2]
+
+class ReopeningCursor(object):
+    '''
+    Cursor over match sorted by _id. If the server kills it (e.g. after
+    the idle timeout) it is opened again after the last _id read, so
+    long scans neither need no_cursor_timeout nor restart from zero.
+    '''
+    def __init__(self, coll, index, match):
+        self.coll = coll
+        self.index = index
+        self.match = match
+        self.last_id = None
+        self.cursor = self.open(match)
+
+    def open(self, match):
+        return open_cursor(self.coll, self.index, match)\
+            .sort('_id', pymongo.ASCENDING)
+
+    def count(self):
+        return self.cursor.count()
+
+    def __iter__(self):
+        while True:
+            try:
+                for doc in self.cursor:
+                    self.last_id = doc['_id']
+                    yield doc
+                return
+
+            except pymongo.errors.CursorNotFound:
+                if self.last_id == None:
+                    self.cursor = self.open(self.match)
+                    continue
+
+                after = {'_id': {'$gt': self.last_id}}
+                if len(self.match) > 0:
+                    after = {'$and': [self.match, after]}
+                self.cursor = self.open(after)
+
+def count_cursor(cursor):
+    # Aggregation results can not be counted without running them twice
+    if isinstance(cursor, pymongo.command_cursor.CommandCursor):
+        return None
+    return cursor.count()
+
+def es_sync_cursor(coll, index, filter_config, es, timeout=None):
+    '''
+    Returns a cursor over the documents newer than the last one found
+    in elasticsearch, or None if that can not be determined.
+    '''
+    sort_body = { 'sort':[] }
+
+    if filter_config.sync_field != None:
+        criterion = filter_config.sync_field # almost legacy
+        sort_body['sort'].extend([
+            {
+                filter_config.sync_field: { 'order': 'desc' }
+            },
+            {
+                filter_config.sync_inc_field(): { 'order': 'desc' }
+            }
+        ])
+    else:
+        criterion = filter_config.common_timestamp # almost legacy
+        sort_body['sort'].append(
+            {
+                filter_config.common_timestamp: { 'order': 'desc' }
+            })
 
+    params = dict()
+    if timeout != None:
+        params['request_timeout'] = timeout
+
+    search_index = filter_config.get_index_name(index)
+    if filter_config.is_time_based(index):
+        # the last document can only be in the newest slice
+        search_index = newest_index(es, search_index)
+        if search_index == None:
+            return None
+
+    # Without try, so it fails in case of RequestError (use --test first)
+    result = es.search(
+        index=search_index,
+        doc_type=filter_config.get_type_name(index),
+        body=sort_body,
+        **params
+    )
+
+    if result != None and result['hits']['total'] > 0:
+        last = result['hits']['hits'][0]
+        ts = dateutil.parser.parse(last['_source'][criterion])
+
+        '''
+        Gets string representation of timestamp if
+        tsformat was specified in settings for this
+        collections (it is assumed that field
+        index.timestamp is a string), else the
+        datetime.datetime timestamp is left unchanged
+        '''
+        get_ts_relative = lambda index, ts: ts.strftime(index.tsformat)\
+                          if index.tsformat != None else ts
+
+        # In case a sync_field is enabled or the timestamp field name
+        # was not set for this collection
+        if filter_config.sync_field != None or index.timestamp == None:
+            '''
+            Create ObjectId with retrieved timestamp from
+            elasticsearch
+            '''
+            has_objectid = (type(coll.find_one()['_id']) ==
+                            bson.objectid.ObjectId)
+
+            if has_objectid:
+                # Try to fully recover object id
+                if bson.objectid.ObjectId.is_valid(last['_id']):
+                    relative = bson.objectid.ObjectId(last['_id'])
+                # Recover from datetime
+                else:
+                    relative = bson.objectid.ObjectId.from_datetime(ts)
+
+                return find(coll, index, {'_id':{'$gt':relative}})
+
+            elif index.timestamp != None:
+                relative = get_ts_relative(index, ts)
+                return find(coll, index, {index.timestamp:{'$gt':relative}})
+        else:
+            '''
+            COMMON_TIMESTAMP is obtained from timestamp
+            in collection
+            '''
+            relative = get_ts_relative(index, ts)
+            return find(coll, index, {index.timestamp:{'$gt':relative}})
+
+    return None
+
+def checkpoint_sync_cursor(coll, index, filter_config, checkpoint):
+    '''
+    Same as es_sync_cursor, using a checkpoint read from the
+    CheckpointStore instead of querying elasticsearch.
+    '''
+    if ((filter_config.sync_field != None or index.timestamp == None) and
+        type(checkpoint.get('_id')) == bson.objectid.ObjectId):
+        return find(coll, index, {'_id':{'$gt':checkpoint['_id']}})
+
+    if index.timestamp != None and checkpoint.has_key('timestamp'):
+        return find(coll, index, {index.timestamp:{'$gt':checkpoint['timestamp']}})
+
+    return None
+
+def update_cursor(coll, index, checkpoint):
+    '''
+    Returns a cursor over the documents modified since the update
+    watermark of checkpoint (everything if there is none), sorted by
+    updated_field so the watermark can follow the acknowledgements.
+    $gte sends again the documents modified in the same instant as
+    the last acknowledged one instead of missing them.
+    '''
+    if checkpoint != None and checkpoint.has_key('updated'):
+        condition = {index.updated_field: {'$gte': checkpoint['updated']}}
+    else:
+        condition = {index.updated_field: {'$exists': True}}
+
+    return find(coll, index, condition, [(index.updated_field, pymongo.ASCENDING)])
+
+def filter_batches(index, docs, timer=None):
+    '''
+    Runs the filter_batch of the collection script over
+    script_batch_size documents at a time. As with filter(doc), the
+    script does not see _id.
+    '''
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) < index.script_batch_size:
+            continue
+
+        for filtered in filter_batch(index, batch, timer):
+            yield filtered
+        batch = []
+
+    for filtered in filter_batch(index, batch, timer):
+        yield filtered
+
+def filter_batch(index, batch, timer=None):
+    if len(batch) == 0:
+        return batch
+
+    if timer != None:
+        timer.lap('read')
+
+    ids = [doc.pop('_id') for doc in batch]
+    index.filter_batch_fn(batch)
+    if timer != None:
+        timer.lap('script')
+    for doc, _id in zip(batch, ids):
+        doc['_id'] = _id
+
+    return batch
+
+def index_collection(position, index, filter_config, es_config,
+                     mongo_client, es, mode, test,
+                     dynamic_mapping=None,
+                     verbose=True,
+                     id_range=None,
+                     checkpoints=None,
+                     hashes=None,
+                     upsert=False,
+                     count=True,
+                     interval=0.5,
+                     max_in_flight=1,
+                     pipeline=False,
+                     profile=False,
+                     target=None):
+    '''
+    Indexes (or checks, if test) a single collection and returns a
+    CollectionReport. Progress is only printed if verbose. If id_range
+    is set, only documents whose _id matches that condition are read.
+    If checkpoints (a CheckpointStore) is set, sync starts from it and
+    full/sync record what they indexed in it, as does update with the
+    updated_field of index, which then only reads the documents
+    modified since its watermark. If hashes (a HashStore)
+    is set, full/update skip the documents that did not change and
+    every mode records what it sent in it. If upsert, update
+    creates the documents that are not indexed yet. Filtered cursors
+    are only counted if count, whole collections use the estimated
+    count. Up to max_in_flight bulk requests are sent while reading.
+    If pipeline, the cursor is also read ahead by a CursorReader thread
+    and stage statistics are kept in the report. If profile, every
+    stage of the per-document loop is timed (see StageTimer). target
+    replaces the configured index name (see --rebuild), checkpoints
+    are not advanced then.
+    '''
     # is this synchronization?
-    sync = args[0] == 'sync'
+    sync = mode == 'sync'
 
     # is this update?
-    update = args[0] == 'update'
+    update = mode == 'update'
+
+    # update of the documents modified since the last one
+    incremental = update and index.updated_field != None and\
+                  checkpoints != None and id_range == None
+
+    report = CollectionReport(position)
+    progress = Progress(index, filter_config, report, interval, verbose)
+
+    if index.db_name not in mongo_client.database_names():
+        print 'Database "%s" not found.' %index.db_name
+        report.nothing_to_do = True
+        return report
+    if index.coll_name not in mongo_client[index.db_name].collection_names():
+        print 'Collection "%s" not found.' %'.'.join((index.db_name, index.coll_name))
+
+    db = mongo_client[index.db_name]
+    coll = db[index.coll_name]
+
+    cursor = None
+    if sync:
+        if checkpoints != None:
+            stored = checkpoints.get(index)
+            if stored != None:
+                cursor = checkpoint_sync_cursor(coll,
+                                                index,
+                                                filter_config,
+                                                stored)
+
+        # No usable checkpoint, ask elasticsearch
+        if cursor == None:
+            cursor = es_sync_cursor(coll, index, filter_config, es,
+                                    es_config.search_timeout)
+
+    # </if sync> ==> full/update
+    elif incremental:
+        cursor = update_cursor(coll, index, checkpoints.get(index))
+    elif id_range != None:
+        cursor = find(coll, index, {'_id': id_range})
+    else:
+        cursor = find(coll, index)
+
+    # Nothing to do
+    if cursor == None:
+        report.nothing_to_do = True
+        return report
+
+    # stats data, None if unknown
+    if not sync and not incremental and id_range == None and\
+       index.query == None and index.pipeline == None:
+        report.total = coll.estimated_document_count()
+    elif count:
+        report.total = count_cursor(cursor)
+    else:
+        report.total = None
+
+    if report.total == 0:
+        report.nothing_to_do = True
+        return report
+
+    cindex = target if target != None else filter_config.get_index_name(index)
+    ctype = filter_config.get_type_name(index)
+
+    # cindex is a pattern, every document has its own index
+    time_based = target == None and filter_config.is_time_based(index)
+
+    # Highest _id/timestamp sent, recorded once acknowledged
+    # A --rebuild target is not live yet, sync must not start after it
+    track = checkpoints != None and not test and target == None and\
+            (not update or incremental)
+    checkpoint = dict()
+
+    if test and update:
+        checker = UpdateChecker(es,
+                                es_config.mget_size,
+                                es_config.search_timeout)
+
+    # Hashes of the documents sent, stored once acknowledged unless
+    # their item failed (or was ignored)
+    hashing = hashes != None and not test
+    sent_hashes = []
+    unwritten = set()
+
+    def tag():
+        acked = (dict(checkpoint), list(sent_hashes))
+        del sent_hashes[:]
+        return acked
+
+    def on_ack(acked):
+        acked_checkpoint, acked_hashes = acked
+        if track:
+            checkpoints.advance(index, acked_checkpoint)
+        if hashing:
+            hashes.put([acked_hash for acked_hash in acked_hashes
+                        if acked_hash[1] not in unwritten])
+            unwritten.clear()
+
+    if not test:
+        tracked = track or hashing
+
+        # element not found on update - leave for sync
+        writer = es_config.bulk_writer(es,
+                                       ignore=(404,) if update and not upsert else (),
+                                       max_in_flight=max_in_flight,
+                                       tag=tag if tracked else None,
+                                       on_ack=on_ack if tracked else None,
+                                       on_unwritten=(lambda action:
+                                                     unwritten.add(action.values()[0]['_id']))\
+                                                    if hashing else None)
+
+    # Tests stop on the first mapping conflict, they keep it simple
+    reader = CursorReader(cursor, index.read_ahead)\
+             if pipeline and not test else None
+
+    docs = reader if reader != None else cursor
+
+    timer = StageTimer() if profile else None
+
+    # the plan is shared by every collection of this process
+    plan_before = filter_config.field_plan.stats()\
+                  if filter_config.field_plan != None else None
+
+    batched = index.filter_batch_fn != None
+    if batched:
+        docs = filter_batches(index, docs, timer)
+
+    if timer != None:
+        timer.start()
+
+    for doc in docs:
+        if timer != None:
+            timer.lap('read')
+
+        if track:
+            track_checkpoint(checkpoint, index, doc, update)
+
+        object_id = doc['_id']
+        _id, doc = transform_doc(index, filter_config, doc, batched, timer)
+
+        # Stat update
+        report.done += 1
+
+        # Index of this document
+        doc_index = cindex if not time_based else\
+                    filter_config.get_index_name(index,
+                                                 doc_time(filter_config,
+                                                          doc,
+                                                          object_id))
+
+        if hashing:
+            # Serialized once, the writer sends strings as they are
+            doc = writer.serializer.dumps(doc)
+            digest = hashes.digest(doc)
+            # sync only reads new documents, no need to look
+            unchanged = not sync and hashes.get(doc_index, _id) == digest
+            if timer != None:
+                timer.lap('hash')
+
+            if unchanged:
+                report.unchanged += 1
+                progress.update('UPDATING' if update else 'INDEXING', writer.sent)
+                continue
+
+            sent_hashes.append((doc_index, _id, digest))
+
+        if update:
+            if test:
+                # Just get it for test reasons
+                checker.check(doc_index, ctype, _id, doc)
+                if timer != None:
+                    timer.lap('check')
+                progress.update('CHECKING FOR UPDATES')
+                continue
+
+            # Let elasticsearch merge
+            writer.update(doc_index, ctype, _id, doc, upsert)
+            if timer != None:
+                timer.lap('write')
+            progress.update('UPDATING', writer.sent)
+            continue
+
+        if test:
+            # Check dynamic mapping simulation
+            conflicting_field = dynamic_mapping.test_doc(index,
+                                                         doc)
+
+            if conflicting_field != None:
+                report.conflicting_field = conflicting_field
+                return report
+
+            if timer != None:
+                timer.lap('check')
+
+            # If test, print progress here
+            progress.update('CHECKING')
+            continue
+
+        # If not a test, actually push to ES
+        writer.index(doc_index, ctype, _id, doc)
+        if timer != None:
+            timer.lap('write')
+
+        # If not test print progress after buffering
+        progress.update('INDEXING', writer.sent)
+
+    # </for doc in coll.find()>
+    if report.total == None:
+        report.total = report.done
+        report.nothing_to_do = report.done == 0
+
+    if test and update:
+        checker.flush()
+        report.updated = checker.behind
+        report.failures = checker.failures
+        report.failed = len(checker.failures)
+
+    if not test:
+        # Push whatever is left in the buffer
+        writer.close()
+
+        report.failures = writer.failures
+        report.failed = writer.failed
+        report.size = writer.sent
+
+        if update:
+            # upserted documents count as updated
+            report.updated = writer.results.get('updated', 0) +\
+                             writer.results.get('created', 0)
+
+    report.elapsed = progress.elapsed()
+    report.set_status(update, test)
+
+    if plan_before != None:
+        report.field_plan = filter_config.field_plan.stats()
+        for key in ('hits', 'misses', 'resets'):
+            report.field_plan[key] -= plan_before[key]
+
+    if timer != None:
+        if not test:
+            # time in _bulk requests, partly overlapping the others
+            timer.add('elasticsearch', writer.busy, writer.requests)
+        report.profile = timer.stats()
+
+    if reader != None:
+        report.stages = {
+            'read': reader.busy,
+            # whatever the loop did besides waiting on the other stages
+            'transform': report.elapsed - reader.wait - writer.blocked,
+            'write': writer.busy,
+            'read_queue': reader.depth_sum,
+            'read_samples': reader.samples,
+            'in_flight': writer.in_flight_sum,
+            'requests': writer.requests
+        }
+
+    return report
+
+def load_watch_state(state_file):
+    try:
+        with open(state_file) as f:
+            return bson.json_util.loads(f.read())
+    except IOError:
+        return dict()
+
+def save_watch_state(state_file, state):
+    # Write and rename, so a crash never leaves half a state file
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(bson.json_util.dumps(state))
+    os.rename(tmp_file, state_file)
+
+def change_stream_events(mongo_client, namespaces, state, max_await_ms):
+    '''
+    Yields (db_name, coll_name, op, _id, doc) for every change of the
+    given namespaces, or None when no change arrived in max_await_ms.
+    op is one of 'index' or 'delete'. state['resume_token'] is updated
+    as changes are yielded.
+    '''
+    pipeline = [{'$match': {'ns': {'$in': [{'db': db_name, 'coll': coll_name}
+                                           for db_name, coll_name in namespaces]}}}]
+
+    stream = mongo_client.watch(pipeline,
+                                full_document='updateLookup',
+                                resume_after=state.get('resume_token'),
+                                max_await_time_ms=max_await_ms)
+
+    with stream:
+        while stream.alive:
+            change = stream.try_next()
+            if change == None:
+                yield None
+                continue
+
+            state['resume_token'] = change['_id']
+            ns = change['ns']
+            op = change['operationType']
+
+            if op in ('insert', 'update', 'replace'):
+                # Document may have been deleted before the lookup
+                if change.get('fullDocument') == None:
+                    continue
+                doc = change['fullDocument']
+                yield ns['db'], ns['coll'], 'index', doc['_id'], doc
+
+            elif op == 'delete':
+                yield ns['db'], ns['coll'], 'delete', change['documentKey']['_id'], None
+
+            elif op == 'invalidate':
+                return
+
+def oplog_events(mongo_client, namespaces, state, max_await_ms):
+    '''
+    Same as change_stream_events, for servers without change streams.
+    Tails local.oplog.rs and keeps the last seen ts in state['oplog_ts'].
+    '''
+    oplog = mongo_client.local['oplog.rs']
+    names = ['%s.%s' %ns for ns in namespaces]
+
+    # Start from now if there is nothing to resume from
+    if state.get('oplog_ts') == None:
+        newest = oplog.find_one(sort=[('$natural', pymongo.DESCENDING)])
+        state['oplog_ts'] = newest['ts']
+
+    while True:
+        cursor = oplog.find({'ts': {'$gt': state['oplog_ts']},
+                             'ns': {'$in': names}},
+                            cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+                            oplog_replay=True)
+        cursor.max_await_time_ms(max_await_ms)
+
+        while cursor.alive:
+            for entry in cursor:
+                state['oplog_ts'] = entry['ts']
+                db_name, coll_name = entry['ns'].split('.', 1)
+
+                if entry['op'] == 'i':
+                    yield db_name, coll_name, 'index', entry['o']['_id'], entry['o']
+
+                elif entry['op'] == 'u':
+                    # Entry may only hold modifiers, look the document up
+                    _id = entry['o2']['_id']
+                    doc = mongo_client[db_name][coll_name].find_one({'_id': _id})
+                    if doc != None:
+                        yield db_name, coll_name, 'index', _id, doc
+
+                elif entry['op'] == 'd':
+                    yield db_name, coll_name, 'delete', entry['o']['_id'], None
+
+            yield None
+
+def watch(indices, filter_config, es_config, watch_config, mongo_client, es,
+          interval=0.5,
+          max_in_flight=1):
+    '''
+    Tails changes of every configured collection and mirrors them in
+    elasticsearch until interrupted. Uses change streams if the server
+    has them (>= 4.0), the oplog otherwise. The resume point is saved
+    in watch_config.state_file once the changes up to it are indexed.
+    '''
+    by_ns = dict(((index.db_name, index.coll_name), index)
+                 for index in indices)
+
+    state = load_watch_state(watch_config.state_file)
+
+    if mongo_client.server_info()['versionArray'] >= [4, 0]:
+        events = change_stream_events
+    else:
+        events = oplog_events
+
+    def acknowledged(acked_state):
+        print_failures(writer.failures)
+        writer.failures = []
+        save_watch_state(watch_config.state_file, acked_state)
+
+    # deleting something that is not indexed is fine
+    writer = es_config.bulk_writer(es,
+                                   ignore=(404,),
+                                   max_in_flight=max_in_flight,
+                                   tag=lambda: dict(state),
+                                   on_ack=acknowledged)
+
+    indexed = 0
+    deleted = 0
+    next_draw = time.time()
+
+    try:
+        for event in events(mongo_client,
+                            by_ns.keys(),
+                            state,
+                            watch_config.max_await_ms):
+            # Stream is idle, push partial batch
+            if event == None:
+                writer.flush()
+                writer.wait()
+                continue
+
+            db_name, coll_name, op, object_id, doc = event
+            index = by_ns[(db_name, coll_name)]
+            cindex = filter_config.get_index_name(index)
+            ctype = filter_config.get_type_name(index)
+            time_based = filter_config.is_time_based(index)
+
+            if op == 'index':
+                _id, doc = transform_doc(index, filter_config, doc)
+                if time_based:
+                    cindex = filter_config.get_index_name(
+                        index, doc_time(filter_config, doc, object_id))
+                writer.index(cindex, ctype, _id, doc)
+                indexed += 1
+            elif not time_based:
+                writer.delete(cindex, ctype, str(object_id))
+                deleted += 1
+            elif ((filter_config.common_timestamp == None or
+                   index.timestamp == None) and
+                  type(object_id) == bson.objectid.ObjectId):
+                # the time comes from the _id, see doc_time
+                writer.delete(filter_config.get_index_name(index,
+                                                           object_id.generation_time),
+                              ctype,
+                              str(object_id))
+                deleted += 1
+            else:
+                # The slice is unknown without the document. Pending
+                # writes go first, so the delete is not undone
+                writer.flush()
+                writer.wait()
+                es.delete_by_query(index=cindex,
+                                   doc_type=ctype,
+                                   body={'query': {'ids': {'values': [str(object_id)]}}})
+                deleted += 1
+
+            now = time.time()
+            if now >= next_draw:
+                next_draw = now + interval
+                sys.stdout.write('[watch] {0} indexed, {1} deleted\r'.format(indexed,
+                                                                              deleted))
+                sys.stdout.flush()
+
+    except KeyboardInterrupt:
+        pass
+
+    writer.close()
+    print
+
+# Per process state of --jobs workers (see init_worker)
+worker_state = dict()
+
+def init_worker(config_path):
+    # Each worker builds its own clients, they must not be shared
+    # across fork()
+    es_config, indices, filter_config, _, sync_config, _, _, _ =\
+        read_config(config_path)
+    worker_state['es_config'] = es_config
+    worker_state['indices'] = indices
+    worker_state['filter_config'] = filter_config
+    worker_state['mongo_client'] = pymongo.MongoClient()
+    worker_state['es'] = es_config.client()
+    worker_state['sync_config'] = sync_config
+    worker_state['checkpoints'] = CheckpointStore(sync_config.checkpoint_file)\
+                                  if sync_config.checkpoint_file != None else None
+    worker_state['hashes'] = HashStore(sync_config.hash_file)\
+                             if sync_config.hash_file != None else None
+
+def run_worker(args):
+    position, mode, id_range, options = args
+    return index_collection(position,
+                            worker_state['indices'][position],
+                            worker_state['filter_config'],
+                            worker_state['es_config'],
+                            worker_state['mongo_client'],
+                            worker_state['es'],
+                            mode,
+                            False,
+                            verbose=False,
+                            id_range=id_range,
+                            checkpoints=worker_state['checkpoints'],
+                            hashes=worker_state['hashes'],
+                            upsert=worker_state['sync_config'].doc_as_upsert,
+                            **options)
+
+def main():
+    optparser = optparse.OptionParser()
+    optparser.add_option('-t', '--test',
+                         action='store_true',
+                         dest='test',
+                         default=False)
+    optparser.add_option('-j', '--jobs',
+                         type='int',
+                         dest='jobs',
+                         default=1)
+    optparser.add_option('-i', '--interval',
+                         type='float',
+                         dest='interval',
+                         default=0.5)
+    optparser.add_option('--no-count',
+                         action='store_false',
+                         dest='count',
+                         default=True)
+    optparser.add_option('-e', '--engine',
+                         type='choice',
+                         choices=('sync', 'overlap', 'pipeline'),
+                         dest='engine',
+                         default='sync')
+    optparser.add_option('-r', '--rebuild',
+                         action='store_true',
+                         dest='rebuild',
+                         default=False)
+    optparser.add_option('-m', '--put-mappings',
+                         action='store_true',
+                         dest='put_mappings',
+                         default=False)
+    opts, args = optparser.parse_args()
+    
+    if len(args) != 2:
+        usage()
+
+    if args[0] not in ('full', 'sync', 'update', 'watch', 'replay'):
+        usage()        
+
+    # watch never ends, there is nothing to simulate
+    if args[0] in ('watch', 'replay') and opts.test:
+        usage()
+
+    # mappings come from the simulation of a full --test run
+    if opts.put_mappings and not (opts.test and args[0] in ('full', 'sync')):
+        usage()
+
+    # only a complete load can replace an index
+    if opts.rebuild and (opts.test or args[0] != 'full'):
+        usage()
+
+    if opts.jobs < 1:
+        usage()
+
+    es_config, indices, filter_config, watch_config, sync_config,\
+        mapping_config, report_config, rebuild_config = read_config(args[1])
+
+    # is this a simulation?
+    test = opts.test
+
+    mode = args[0]
+
+    # Dynamic mapping simulation spans collections, so tests always
+    # run in this process
+    jobs = 1 if test else opts.jobs
+
+    # overlap keeps sending bulk requests while reading, pipeline
+    # also reads ahead in another thread
+    max_in_flight = es_config.max_in_flight\
+                    if opts.engine in ('overlap', 'pipeline') else 1
 
     # Instantiate a simulation
-    if test:
-        dynamic_mapping = DynamicMappingSimulation()
+    dynamic_mapping = DynamicMappingSimulation() if test else None
 
     # One of those options must be set
-    if (sync and filter_config.sync_field == None and
+    if (mode == 'sync' and filter_config.sync_field == None and
         filter_config.common_timestamp == None):
         
         print '[ERROR] sync_field nor common_timestamp are not set. Cowardly Aborting.'
         return 1
 
-    if update:
-        update_counters = {}
+    if mode == 'replay':
+        if es_config.dead_letter_dir == None:
+            print '[ERROR] dead_letter_dir is not set, nothing to replay.'
+            return 1
+
+        return replay(es_config, es_config.client())
+
+    if mode == 'watch':
+        return watch(indices,
+                     filter_config,
+                     es_config,
+                     watch_config,
+                     pymongo.MongoClient(),
+                     es_config.client(),
+                     opts.interval,
+                     max_in_flight)
+
+    update_counters = {}
+
+    # Only this process is sampled, workers of --jobs are not
+    sampler = StackSampler(report_config.sample_interval)\
+              if report_config.sample_file != None else None
+    if sampler != None:
+        sampler.start()
+
+    started = time.time()
+    # collection_summary of every collection, for the run reports
+    summaries = []
+
+    # index name (an alias once done) -> (versioned index, settings to
+    # restore) of --rebuild
+    rebuilds = dict()
+    if opts.rebuild:
+        if any(filter_config.is_time_based(index) for index in indices):
+            print '[ERROR] --rebuild does not support time-based index names.'
+            return 1
+
+        suffix = time.strftime(rebuild_config.suffix_format)
+        for index in indices:
+            alias = filter_config.get_index_name(index)
+            if not rebuilds.has_key(alias):
+                rebuilds[alias] = prepare_rebuild(es_config.client(), alias, suffix)
+
+    # aliases of --rebuild that must not be switched
+    incomplete = set()
+
+    # Where each collection is written, the configured name if None
+    targets = [rebuilds[filter_config.get_index_name(index)][0]
+               if opts.rebuild else None
+               for index in indices]
 
     # Aesthetics
     print_title()
 
     # Print nothing to do in the end
     nothing_to_do = []
-    
-    for index in indices:
-        if index.db_name not in mongo_client.database_names():
-            print 'Database "%s" not found.' %db_name
-            continue
-        if index.coll_name not in mongo_client[index.db_name].collection_names():
-            print 'Collection "%s" not found.' %'.'.join(index.db_name, index.coll_name)
-
-        db = mongo_client[index.db_name]
-        coll = db[index.coll_name]
-
-        cursor = None
-        if sync:
-            sort_body = { 'sort':[] }
-
-            if filter_config.sync_field != None:
-                criterion = filter_config.sync_field # almost legacy
-                sort_body['sort'].extend([
-                    {
-                        filter_config.sync_field: { 'order': 'desc' }
-                    },
-                    {
-                        filter_config.sync_inc_field(): { 'order': 'desc' }
-                    }
-                ])
+
+    if jobs == 1:
+        # Initialize Mongo client
+        mongo_client = pymongo.MongoClient()
+
+        # Initialize elasticsearch client
+        es = es_config.client()
+
+        checkpoints = CheckpointStore(sync_config.checkpoint_file)\
+                      if sync_config.checkpoint_file != None else None
+
+        hashes = HashStore(sync_config.hash_file)\
+                 if sync_config.hash_file != None else None
+
+        reports = (index_collection(position,
+                                    index,
+                                    filter_config,
+                                    es_config,
+                                    mongo_client,
+                                    es,
+                                    mode,
+                                    test,
+                                    dynamic_mapping,
+                                    checkpoints=checkpoints,
+                                    hashes=hashes,
+                                    upsert=sync_config.doc_as_upsert,
+                                    count=opts.count,
+                                    interval=opts.interval,
+                                    max_in_flight=max_in_flight,
+                                    pipeline=opts.engine == 'pipeline',
+                                    profile=report_config.profile,
+                                    target=targets[position])
+                   for position, index in enumerate(indices))
+    else:
+        # Only used before forking, workers have their own client
+        mongo_client = pymongo.MongoClient()
+
+        # index_collection options of every task
+        options = {'count': opts.count,
+                   'max_in_flight': max_in_flight,
+                   'pipeline': opts.engine == 'pipeline',
+                   'profile': report_config.profile}
+
+        tasks = []
+        for position, index in enumerate(indices):
+            # watermarks (sync, update with updated_field) need a
+            # single ordered scan
+            if mode == 'sync' or index.partitions < 2 or\
+               (mode == 'update' and index.updated_field != None and
+                sync_config.checkpoint_file != None):
+                tasks.append((position, mode, None,
+                              dict(options, target=targets[position])))
+                continue
+
+            # Split big collections by _id so partitions run in parallel
+            coll = mongo_client[index.db_name][index.coll_name]
+            for id_range in partition_id_ranges(coll, index.partitions):
+                tasks.append((position, mode, id_range,
+                              dict(options, target=targets[position])))
+
+        mongo_client.close()
+
+        # Partition reports are merged before printing
+        pending = dict()
+        for task in tasks:
+            pending[task[0]] = pending.get(task[0], 0) + 1
+        partials = dict()
+
+        pool = multiprocessing.Pool(jobs,
+                                    initializer=init_worker,
+                                    initargs=(args[1],))
+        reports = pool.imap_unordered(run_worker, tasks)
+        pool.close()
+
+    for report in reports:
+        if jobs > 1:
+            position = report.position
+            if partials.has_key(position):
+                partials[position].merge(report)
+                report = partials[position]
             else:
-                criterion = filter_config.common_timestamp # almost legacy
-                sort_body['sort'].append(
-                    {
-                        filter_config.common_timestamp: { 'order': 'desc' }
-                    })
-                    
-            # Without try, so it fails in case of RequestError (use --test first)
-            result = es.search(
-                index=filter_config.get_index_name(index),
-                doc_type=filter_config.get_type_name(index),
-                body=sort_body
-            )
-
-            if result != None and result['hits']['total'] > 0:
-                last = result['hits']['hits'][0]
-                ts = dateutil.parser.parse(last['_source'][criterion])
-
-                '''
-                Gets string representation of timestamp if
-                tsformat was specified in settings for this
-                collections (it is assumed that field
-                index.timestamp is a string), else the
-                datetime.datetime timestamp is left unchanged
-                '''
-                get_ts_relative = lambda index, ts: ts.strftime(index.tsformat)\
-                                  if index.tsformat != None else ts
-
-                # In case a sync_field is enabled or the timestamp field name
-                # was not set for this collection
-                if filter_config.sync_field != None or index.timestamp == None:
-                    '''
-                    Create ObjectId with retrieved timestamp from
-                    elasticsearch
-                    '''
-                    has_objectid = (type(coll.find_one()['_id']) ==
-                                    bson.objectid.ObjectId)
-
-                    if has_objectid:
-                        # Try to fully recover object id
-                        if bson.objectid.ObjectId.is_valid(last['_id']):
-                            relative = bson.objectid.ObjectId(last['_id'])
-                        # Recover from datetime
-                        else:
-                            relative = bson.objectid.ObjectId.from_datetime(ts)
-
-                        cursor = coll.find({'_id':{'$gt':relative}})
-                        
-                    elif index.timestamp != None:
-                        relative = get_ts_relative(index, ts)
-                        cursor = coll.find({index.timestamp:{'$gt':relative}})
-                else:
-                    '''
-                    COMMON_TIMESTAMP is obtained from timestamp
-                    in collection
-                    '''
-                    relative = get_ts_relative(index, ts)
-                    cursor = coll.find({index.timestamp:{'$gt':relative}})
-
-        # </if sync> ==> full/update
-        else:
-            cursor = coll.find()                
+                partials[position] = report
+
+            pending[position] -= 1
+            if pending[position] > 0:
+                continue
 
-        # Nothing to do
-        if cursor == None or cursor.count() == 0:
+            report.set_status(mode == 'update', test)
+
+        index = indices[report.position]
+        summaries.append(collection_summary(index, filter_config, report))
+
+        # A rebuilt index only replaces the live one if all its
+        # collections were read and written
+        if opts.rebuild and (report.nothing_to_do or report.done == 0 or
+                             report.failed > 0):
+            incomplete.add(filter_config.get_index_name(index))
+
+        if report.nothing_to_do:
             nothing_to_do.append(index)
             continue
-            
-        # stats data
-        total = cursor.count()
-        i = 0
-            
-        for doc in cursor:
-            object_id = doc['_id']
-            _id = str(object_id)
-            del doc['_id']
 
-            index.filter_fn(doc)
+        if report.conflicting_field != None:
+            conflicting_field = report.conflicting_field
+            # pretty_field(db_name, coll_name, field)
+            pretty_field = lambda d, c, f: '%s:%s[%s]' %(d, c, f)
+
+            print 'Dynamic Mapping test failed:'
+            print '\tOriginal field:', pretty_field(conflicting_field.db_name,
+                                                    conflicting_field.coll_name,
+                                                    conflicting_field.name)
+            print '\tConflicting field:', pretty_field(index.db_name,
+                                                       index.coll_name,
+                                                       conflicting_field.name)
+            return
 
-            # Add a common timestamp field if set in filters
-            filter_config.add_common_timestamp_ifset(doc,
-                                                     index.timestamp,
-                                                     index.tsformat)
+        # collections (and partitions) may share an index/type
+        if mode == 'update':
+            joined = '%s/%s' %(filter_config.get_index_name(index),
+                               filter_config.get_type_name(index))
+            update_counters[joined] = update_counters.get(joined, 0) +\
+                                      report.updated
 
-            # Add a sync timestamp field if set in filters
-            filter_config.add_sync_field_ifset(doc, object_id)
-            
-            if not filter_config.is_default():
-                filter_config.filter_fields(doc,
-                                            index.db_name,
-                                            index.coll_name)
+        print_progress(index, filter_config, report.done, report.total,
+                       report.status,
+                       format_rate(report.done, report.size, report.elapsed))
+        print
 
-            # Stat update
-            i += 1
-                
-            if update:
-                if test:
-                    print_progress(index, filter_config, i, total, 'CHECKING FOR UPDATES')
-                else:
-                    print_progress(index, filter_config, i, total, 'UPDATING')
-                
-                cindex = filter_config.get_index_name(index)
-                ctype = filter_config.get_type_name(index)
-                joined = '%s.%s' %(cindex, ctype)
+        if report.stages != None:
+            print '          %s' %format_stages(report.stages)
 
-                if not update_counters.has_key(joined):
-                    update_counters[joined] = 0
-                
-                would_update = False
-                
-                try:
-                    if test:
-                        # Just get it for test reasons
-                        found = es.get(index=cindex,
-                                       doc_type=ctype,
-                                       id=_id)
-                        # naive criterion
-                        would_update = len(found['_source'].keys()) != len(doc.keys())
-                        update_counters[joined] += 1 if would_update else 0
-                        continue
-                    
-                    # Let elasticsearch merge
-                    result = es.update(index=index.index,
-                                       doc_type=index.type,
-                                       id=_id,
-                                       body={'doc':doc})
-
-                    update_counters[joined] += 1 if result['result'] == 'updated' else 0
-                        
-                    
-                except elasticsearch.TransportError as e:
-                    # element not found - leave for sync
-                    if e.status_code == 404:
-                        # Left for sync
-                        pass
-                    else:
-                        raise
+        if report.profile != None:
+            print '          %s' %format_profile(report.profile)
 
-                continue
-                                                
-            if test:
-                # Check dynamic mapping simulation
-                conflicting_field = dynamic_mapping.test_doc(index,
-                                                             doc)
-
-                if conflicting_field != None:
-                    # pretty_field(db_name, coll_name, field)
-                    pretty_field = lambda d, c, f: '%s:%s[%s]' %(d, c, f)
-                    
-                    print 'Dynamic Mapping test failed:'
-                    print '\tOriginal field:', pretty_field(conflicting_field.db_name,
-                                                            conflicting_field.coll_name,
-                                                            conflicting_field.name)
-                    print '\tConflicting field:', pretty_field(index.db_name,
-                                                               index.coll_name,
-                                                               conflicting_field.name)
-                    return
-                
-                # If test, print progress here
-                print_progress(index, filter_config, i, total, 'CHECKING')
-                continue
-            
-            # If not a test, actually push to ES
-            es.index(index=filter_config.get_index_name(index),
-                     doc_type=filter_config.get_type_name(index),
-                     id=_id,
-                     body=doc)
+        if report.field_plan != None:
+            print '          %s' %format_field_plan(report.field_plan)
 
-            # If not test print progress after indexing
-            print_progress(index, filter_config, i, total, 'INDEXING')
+        print_failures(report.failures)
 
-        # </for doc in coll.find()>
-        if test:
-            if update:
-                # joined is in if update: ^
-                if update_counters[joined] > 0:
-                    print_progress(index,
-                                   filter_config,
-                                   i,
-                                   total,
-                                   'BEHIND BY %d DOCS' % update_counters[joined])
-                else:
-                    print_progress(index, filter_config, i, total, 'UP TO DATE')
-            else:
-                print_progress(index, filter_config, i, total, 'OK')
-        else:
-            if update:
-                if update_counters[joined] > 0:
-                    print_progress(index,
-                                   filter_config,
-                                   i,
-                                   total,
-                                   '%d DOCS UPDATED' %update_counters[joined])
-                else:
-                    print_progress(index,
-                                   filter_config,
-                                   i,
-                                   total,
-                                   'UP TO DATE')
-            else:
-                print_progress(index, filter_config, i, total, 'INDEXED')
-        print
+        if report.failed > 0 and es_config.dead_letter_dir != None:
+            print '[ ! ] %d rejected documents spooled to %s' %(report.failed,
+                                                               es_config.dead_letter_dir)
+
+    if jobs > 1:
+        pool.join()
 
     print
     for index in nothing_to_do:
         print '[ ! ] Nothing to do for %s.%s' %(index.db_name,
                                                     index.coll_name)
 
+    for joined, updated in sorted(update_counters.items()):
+        if test:
+            print '[ * ] %s is behind by %d docs' %(joined, updated)
+        else:
+            print '[ * ] %d docs updated in %s' %(updated, joined)
+
     if test:
         print '\nTest passed succesfully.'
 
+    if opts.rebuild:
+        print
+        es = es_config.client()
+        for alias, (name, restore) in sorted(rebuilds.items()):
+            if alias in incomplete:
+                # The live index stays as it is
+                print '[ ! ] %s is incomplete, %s still points to the live index' %(name,
+                                                                                  alias)
+                continue
+
+            finish_rebuild(es, alias, name, restore, rebuild_config)
+
+    if sampler != None:
+        sampler.stop()
+        sampler.write(report_config.sample_file)
+
+    run = {'mode': mode,
+           'test': test,
+           'engine': opts.engine,
+           'jobs': jobs,
+           'started': started,
+           'elapsed': time.time() - started,
+           'docs': sum(summary['done'] for summary in summaries),
+           'failed': sum(summary['failed'] for summary in summaries),
+           'collections': summaries}
+
+    if report_config.json_file != None:
+        write_json_report(report_config.json_file, run)
+
+    if report_config.prometheus_file != None:
+        write_prometheus(report_config.prometheus_file, run)
+
+    if opts.put_mappings:
+        print
+        put_mappings(es_config.client(),
+                     dynamic_mapping.mappings(filter_config,
+                                              mapping_config.keyword_length),
+                     mapping_config.dynamic)
+
                 
 
 if __name__ == '__main__':